@@ -1,7 +1,9 @@
 import simplejson
 from aiohttp import web, MultipartReader
 from asynapplicationinsights.aiohttp import use_application_insights
-from main.config import instrumentation_key, db, static_db
+from main.config import instrumentation_key, db, static_db, telemetry
+from main.middleware import db_unavailable_middleware
+from main.auth import start_token_index, stop_token_index
 import mapper.business
 import mapper.session
 
@@ -17,9 +19,32 @@ mapper_session = mapper.session.MapperSession(db, static_db, mapper_business)
 
 
 
-app = web.Application()
+app = web.Application(middlewares=[db_unavailable_middleware])
 use_application_insights(app, instrumentation_key=instrumentation_key)
 
 endpoint.business_endpoint.get_endpoints(app, mapper_business)
 endpoint.session_endpoint.get_endpoints(app, mapper_business, mapper_session)
+
+
+async def close_db(app):
+    await db.close()
+
+
+async def flush_ai_client():
+    await app.ai_client.flush()
+
+
+async def start_telemetry(app):
+    telemetry.start()
+
+
+async def stop_telemetry(app):
+    await telemetry.stop()
+
+telemetry.add_flush_hook(flush_ai_client)
+app.on_startup.append(start_telemetry)
+app.on_startup.append(start_token_index)
+app.on_cleanup.append(stop_token_index)
+app.on_cleanup.append(stop_telemetry)
+app.on_cleanup.append(close_db)
 web.run_app(app, host='0.0.0.0', port=6789)
\ No newline at end of file
@@ -1,12 +1,17 @@
 import simplejson
 from aiohttp import web, MultipartReader
-from main.auth import authenticate
+from main.auth import authenticate, invalidate_business
 # from zope.interface import implementer
-from main.decorator import json_format_result
+from main.decorator import json_format_result, get_json_loads, stream_csv_response, stream_ndjson_response
+from main.serializer import json_response
 from endpoint import base
 from lib.hash_password import hash_password
+from mapper.business import EXPORT_COLUMNS
 
 def get_endpoints(app, mapper_business):
+    # request bodies only parse the timestamp and date columns of the business dto
+    business_loads = get_json_loads(mapper_business.DtoClass)
+
     @authenticate
     async def get_business_request(request):
         # print(request.business)
@@ -19,15 +24,14 @@ def get_endpoints(app, mapper_business):
         elif username:
             dto = mapper_business.get_dto(username=username)
             dto = await mapper_business.select_business(dto, "username")
-        await app.ai_client.flush()
-        return web.Response(text=json_format_result(dto), status=200)
+        return json_response(dto)
 
     @authenticate
     async def insert_new_business(request):
         if request.business:
             if request.business.id != 1:
                 return web.Response(text="Not authorized", status=401)
-        json_data = await request.json()
+        json_data = await request.json(loads=business_loads)
         if json_data.get("id"):
             del json_data["id"]
         if json_data.get("created"):
@@ -35,20 +39,19 @@ def get_endpoints(app, mapper_business):
         # print(json_data)
         dto = mapper_business.get_dto(**json_data)
         dto = await mapper_business.insert_business(dto)
-        await app.ai_client.flush()
-        return web.Response(text=json_format_result(dto), status=200)
+        return json_response(dto)
 
     @authenticate
     async def get_options(request):
         dto = mapper_business.get_properties()
-        return web.Response(text=json_format_result(dto), status=200)
+        return json_response(dto)
 
     @authenticate
     async def update_business(request):
         if request.business:
             if request.business.id != 1:
                 return web.Response(text="Not authorized", status=401)
-        json_data = await request.json()
+        json_data = await request.json(loads=business_loads)
         if json_data.get("created"):
             del json_data["created"]
 
@@ -70,8 +73,10 @@ def get_endpoints(app, mapper_business):
         else:
             return web.Response(text="not sufficient data", status=500)
 
-        await app.ai_client.flush()
-        return web.Response(text=json_format_result(dto), status=200)
+        if dto:
+            # password or role may have changed, cached credentials must be verified again
+            invalidate_business(dto.id)
+        return json_response(dto)
 
     async def adjust_hash_password(dto, json_data):
         for key, val in json_data.items():
@@ -80,10 +85,24 @@ def get_endpoints(app, mapper_business):
             else:
                 dto.update_attr(key, val)
 
+    @authenticate
+    async def export_business(request):
+        if request.business:
+            if request.business.id != 1:
+                return web.Response(text="Not authorized", status=401)
+        export_format = base.get_request_arg(request, 'format') or 'csv'
+        if export_format not in ('csv', 'ndjson'):
+            return web.Response(text="format must be csv or ndjson", status=400)
+        columns, rows = mapper_business.iterate_all(EXPORT_COLUMNS)
+        if export_format == 'csv':
+            return await stream_csv_response(request, columns, rows, filename='business.csv')
+        return await stream_ndjson_response(request, rows, filename='business.ndjson')
+
     app.router.add_route('GET', '/business', get_business_request)
     app.router.add_route('POST', '/business', insert_new_business)
     app.router.add_route('PUT', '/business', update_business)
     app.router.add_route('OPTIONS', '/business', get_options)
+    app.router.add_route('GET', '/business/export', export_business)
 
 
 
@@ -1,9 +1,11 @@
 import simplejson
 from aiohttp import web, MultipartReader
-from main.auth import authenticate
-from main.decorator import json_format_result
+from main.auth import authenticate, token_index
+from main.decorator import json_format_result, stream_csv_response, stream_ndjson_response
+from main.serializer import json_response
 from endpoint import base
 from lib.hash_password import hash_password
+from mapper.session import is_session_expired, EXPORT_COLUMNS
 from datetime import datetime
 
 def get_endpoints(app, mapper_business, mapper_session):
@@ -20,13 +22,19 @@ def get_endpoints(app, mapper_business, mapper_session):
             if hash_password(password.encode('utf-8')) == business_dto.password:
                 token_dto = mapper_session.get_dto(business_id=business_dto.id)
                 token_dto = await mapper_session.select_token(token_dto, 'business_id')
+                if token_dto and is_session_expired(dict(token_dto)):
+                    token_index.discard(token_dto.id)
+                    token_dto = await mapper_session.renew_token(token_dto)
+                    if token_dto:
+                        token_index.add(dict(token_dto))
                 if not token_dto:
                     # insert
                     token_dto = mapper_session.get_dto(modified=datetime.now(), lifetime=60 * 60 * 24 * 30, business_id=business_dto.id)  # 1 month
                     token_dto = await mapper_session.insert_token(token_dto)
+                    if token_dto:
+                        token_index.add(dict(token_dto))
                 # print("correct", token_dto)
-        await app.ai_client.flush()
-        return web.Response(text=json_format_result(token_dto), status=200)
+        return json_response(token_dto)
 
     async def add_token(request):
         # print(request.business)
@@ -39,17 +47,30 @@ def get_endpoints(app, mapper_business, mapper_session):
         elif username:
             dto = mapper_business.get_dto(username=username)
             dto = await mapper_business.select_business(dto, "username")
-        await app.ai_client.flush()
-        return web.Response(text=json_format_result(dto), status=200)
+        return json_response(dto)
 
     @authenticate
     async def get_options(request):
         dto = mapper_session.get_properties()
-        return web.Response(text=json_format_result(dto), status=200)
+        return json_response(dto)
+
+    @authenticate
+    async def export_session(request):
+        if request.business:
+            if request.business.id != 1:
+                return web.Response(text="Not authorized", status=401)
+        export_format = base.get_request_arg(request, 'format') or 'csv'
+        if export_format not in ('csv', 'ndjson'):
+            return web.Response(text="format must be csv or ndjson", status=400)
+        columns, rows = mapper_session.iterate_all(EXPORT_COLUMNS)
+        if export_format == 'csv':
+            return await stream_csv_response(request, columns, rows, filename='session.csv')
+        return await stream_ndjson_response(request, rows, filename='session.ndjson')
 
     app.router.add_route('PUT', '/token', add_token)
     app.router.add_route('POST', '/token', get_session_request)
     app.router.add_route('OPTIONS', '/token', get_options)
+    app.router.add_route('GET', '/token/export', export_session)
 
 
 
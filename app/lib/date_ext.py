@@ -1,4 +1,4 @@
-from datetime import datetime, timedelta
+from datetime import datetime, date, timedelta
 import psycopg2
 import dateutil.parser
 from pytz import timezone, utc
@@ -80,7 +80,11 @@ def datetimetz(datetime_stamp, tz=psycopg2.tz.FixedOffsetTimezone()):
 
 
 def parse_isoformat(string):
-    timestamp = dateutil.parser.parse(string)
+    try:
+        # C implementation, handles what datetime.isoformat() writes
+        timestamp = datetime.fromisoformat(string)
+    except ValueError:
+        timestamp = dateutil.parser.parse(string)
     try:
         old_tz_info = timestamp.tzinfo.utcoffset(None)
     except:
@@ -91,6 +95,13 @@ def parse_isoformat(string):
     return timestamp
 
 
+def parse_isodate(string):
+    try:
+        return date.fromisoformat(string)
+    except ValueError:
+        return dateutil.parser.parse(string).date()
+
+
 def get_market_time():
     current = datetime.utcnow().replace(tzinfo=utc)
     return current.astimezone(timezone('America/New_York'))
@@ -1,12 +1,14 @@
 import asyncio
 import logging
+import random
 import time
 import asyncpg
 import re
 import traceback
 import os
 
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from contextlib import asynccontextmanager
 
 
 class NullHandler(logging.Handler):
@@ -24,14 +26,142 @@ log.addHandler(NullHandler())
 ExecutionResults = namedtuple('ExecutionResults', ['query_data', 'columns'])
 
 RECONNECT_ATTEMPTS = 5
+RECONNECT_BASE_DELAY = 0.1
+RECONNECT_MAX_DELAY = 5
+
+# Circuit breaker settings
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_RESET_TIMEOUT = 30
+
+# errors that mean the database itself can not be reached
+CONNECTION_ERRORS = (OSError, asyncpg.PostgresConnectionError, asyncpg.ConnectionDoesNotExistError)
+CONNECT_ERRORS = CONNECTION_ERRORS + (asyncio.TimeoutError,)
+
+# Pool settings
+POOL_MIN_SIZE = 5
+POOL_MAX_SIZE = 20
+POOL_IDLE_LIFETIME = 300  # seconds an idle connection is kept before being recycled
+ACQUIRE_TIMEOUT = 10
+HEALTH_CHECK_SQL = 'SELECT 1'
+# pooled connections idle for longer than this are checked before reuse
+HEALTH_CHECK_AFTER = 30
+
+# statements asyncpg keeps prepared per connection, 0 turns the cache off
+STATEMENT_CACHE_SIZE = 100
+
+# rows a server side cursor fetches per round trip
+CURSOR_PREFETCH = 500
+
+
+class DatabaseUnavailableError(Exception):
+    def __init__(self, message, retry_after=BREAKER_RESET_TIMEOUT):
+        Exception.__init__(self, message)
+        self.retry_after = retry_after
+
+
+def get_backoff_delay(attempt, base=RECONNECT_BASE_DELAY, cap=RECONNECT_MAX_DELAY):
+    """
+    Exponential backoff with full jitter, so clients reconnecting after a blip
+    do not all hit the database at the same moment.
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class CircuitBreaker(object):
+    """
+    closed: calls go through.
+    open: failure_threshold consecutive failures happened, calls fail fast until
+          reset_timeout has passed.
+    half-open: reset_timeout has passed, one call is let through to probe the
+               database; its result closes or re-opens the breaker.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def retry_after(self):
+        if self.opened_at is None:
+            return 0
+        return max(0, int(self.reset_timeout - (time.monotonic() - self.opened_at)) + 1)
+
+    def allow(self):
+        state = self.state
+        if state == self.HALF_OPEN:
+            # re-arm the timer so only this caller probes the database
+            self.opened_at = time.monotonic()
+            return True
+        return state == self.CLOSED
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                log.error('Database circuit opened after {} failures'.format(self.failures))
+            self.opened_at = time.monotonic()
+
+
+class StatementCacheConnection(asyncpg.Connection):
+    """
+    asyncpg connection carrying an LRU of the SQL texts it has run, mirroring
+    asyncpg's own statement cache for the hit/miss counters. Only text is kept:
+    PreparedStatement objects refuse to run once their connection has been
+    released back to the pool, asyncpg's cache survives the release.
+    """
+    def __init__(self, *args, **kwargs):
+        asyncpg.Connection.__init__(self, *args, **kwargs)
+        self.statement_texts = OrderedDict()
+        self.released_at = None
+
+    # methods rather than attribute writes, pool proxies only forward lookups
+    def mark_released(self):
+        self.released_at = time.monotonic()
+
+    def get_idle_time(self):
+        if self.released_at is None:
+            return 0
+        return time.monotonic() - self.released_at
 
 
 class PGExecutor(object):
     """
     Async postgres for python3.7
+
+    use_pool=False keeps the historical behaviour of one shared connection.
+    use_pool=True hands every caller its own connection from an asyncpg pool, so
+    concurrent handlers no longer wait on each other.
+
+    Reconnects back off without blocking the event loop. While the database is
+    down the circuit breaker raises DatabaseUnavailableError straight away, check
+    is_available to short-circuit work before touching the database.
+
+    fetch_one_row, fetch_all_rows and modify_rows run through asyncpg's prepared
+    statement cache, statement_cache_size entries per connection (LRU).
+    get_statement_stats() reports the hit/miss/eviction counters.
     """
 
-    def __init__(self, username, password, host, port='5432', database='posrgres'):
+    def __init__(self, username, password, host, port='5432', database='posrgres',
+                 use_pool=False, min_size=POOL_MIN_SIZE, max_size=POOL_MAX_SIZE,
+                 idle_lifetime=POOL_IDLE_LIFETIME, acquire_timeout=ACQUIRE_TIMEOUT,
+                 health_check=True, health_check_after=HEALTH_CHECK_AFTER, breaker=None,
+                 statement_cache_size=STATEMENT_CACHE_SIZE):
 
         self.username = username
         self.password = password
@@ -40,26 +170,188 @@ class PGExecutor(object):
         self.database = database.lower()
         self.connect = None
 
-    async def get_connection(self):
-        for retry in range(RECONNECT_ATTEMPTS, -1, -1):
+        self.use_pool = use_pool
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_lifetime = idle_lifetime
+        self.acquire_timeout = acquire_timeout
+        self.health_check = health_check
+        self.health_check_after = health_check_after
+        self.pool = None
+        self._pool_lock = None
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.statement_cache_size = statement_cache_size
+        self.statement_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    @property
+    def is_available(self):
+        return self.breaker.state != CircuitBreaker.OPEN
+
+    def check_available(self):
+        if not self.breaker.allow():
+            raise DatabaseUnavailableError('Database {} at {} is unavailable'.format(self.database, self.host),
+                                           retry_after=self.breaker.retry_after())
+
+    async def _retry_connect(self, connect_factory, errors=CONNECT_ERRORS):
+        """
+        Await connect_factory() until it succeeds, sleeping with jittered
+        exponential backoff between attempts. Every failed attempt counts against
+        the circuit breaker; once it opens the remaining retries are abandoned.
+        """
+        for attempt in range(RECONNECT_ATTEMPTS + 1):
+            self.check_available()
             try:
-                if self.connect is not None and not self.connect.is_closed():
-                    return self.connect
-                loop = asyncio.get_event_loop()
-                self.connect = await asyncpg.connect(database=self.database.lower(),
+                result = await connect_factory()
+                self.breaker.record_success()
+                return result
+            except errors as error:
+                self.breaker.record_failure()
+                print('Error Occured at Database Connection Creation {}'.format(error))
+                print(self.database, self.host)
+                if attempt == RECONNECT_ATTEMPTS:
+                    raise
+                delay = get_backoff_delay(attempt)
+                log.warning('Could not connect to Database. Will retry in {:.2f} seconds. {} retries left'.format(
+                    delay, RECONNECT_ATTEMPTS - attempt))
+                await asyncio.sleep(delay)
+
+    async def get_connection(self):
+        if self.connect is not None and not self.connect.is_closed():
+            return self.connect
+
+        async def connect():
+            loop = asyncio.get_event_loop()
+            return await asyncpg.connect(database=self.database.lower(),
+                                         user=self.username,
+                                         password=self.password,
+                                         host=self.host,
+                                         port=self.port,
+                                         loop=loop,
+                                         statement_cache_size=self.statement_cache_size,
+                                         connection_class=StatementCacheConnection)
+
+        self.connect = await self._retry_connect(connect)
+        return self.connect
+
+    async def get_pool(self):
+        """
+        Create the connection pool on first use.
+        min_size connections are opened up front, idle ones above that are closed
+        after idle_lifetime seconds and reopened on demand.
+        """
+        if self.pool is not None:
+            return self.pool
+        if self._pool_lock is None:
+            self._pool_lock = asyncio.Lock()
+        async with self._pool_lock:
+            if self.pool is None:
+                self.pool = await self._retry_connect(
+                    lambda: asyncpg.create_pool(database=self.database.lower(),
                                                 user=self.username,
                                                 password=self.password,
                                                 host=self.host,
                                                 port=self.port,
-                                                loop=loop)
-                return self.connect
-            except Exception as error:
-                print('Error Occured at Database Connection Creation {}'.format(error))
-                print(self.database, self.host)
-                if retry == 0:
-                    raise
-                log.warning('Could not connect to Database. Will retry in 10 seconds. {} retries left'.format(retry))
-                time.sleep(1)
+                                                min_size=self.min_size,
+                                                max_size=self.max_size,
+                                                max_inactive_connection_lifetime=self.idle_lifetime,
+                                                statement_cache_size=self.statement_cache_size,
+                                                connection_class=StatementCacheConnection))
+        return self.pool
+
+    async def _acquire_from_pool(self, pool):
+        connect = await pool.acquire(timeout=self.acquire_timeout)
+        # recently used connections skip the extra round trip
+        if not self.health_check or connect.get_idle_time() < self.health_check_after:
+            return connect
+        try:
+            await connect.fetchval(HEALTH_CHECK_SQL)
+            return connect
+        except (asyncpg.PostgresConnectionError, asyncpg.InterfaceError, OSError) as error:
+            log.warning('Dropping broken pooled connection: {}'.format(error))
+            # a terminated connection is replaced by the pool on its next acquire
+            connect.terminate()
+            await pool.release(connect)
+        except BaseException:
+            # cancelled or failed mid check, the connection still goes back
+            await pool.release(connect)
+            raise
+        return await pool.acquire(timeout=self.acquire_timeout)
+
+    @asynccontextmanager
+    async def acquire(self):
+        """
+        async with db.acquire() as connect:
+            await connect.fetch(...)
+
+        Yields a pooled connection that is released on exit, or the shared
+        connection when the executor is not pooled.
+        """
+        if not self.use_pool:
+            connect = await self.get_connection()
+            try:
+                yield connect
+            except CONNECTION_ERRORS:
+                self.breaker.record_failure()
+                raise
+            return
+
+        pool = await self.get_pool()
+        # the pool reconnects dead connections on acquire, which can fail the same way
+        connect = await self._retry_connect(lambda: self._acquire_from_pool(pool), errors=CONNECTION_ERRORS)
+        try:
+            yield connect
+        except CONNECTION_ERRORS:
+            self.breaker.record_failure()
+            raise
+        finally:
+            connect.mark_released()
+            await pool.release(connect)
+
+    @asynccontextmanager
+    async def transaction(self):
+        """
+        async with db.transaction() as connect:
+            await connect.execute(...)
+            await connect.execute(...)
+
+        A pooled connection inside a transaction, committed on exit and rolled
+        back when the block raises.
+        """
+        async with self.acquire() as connect:
+            async with connect.transaction():
+                yield connect
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+        if self.connect is not None and not self.connect.is_closed():
+            await self.connect.close()
+        self.connect = None
+
+    def get_statement_stats(self):
+        stats = dict(self.statement_stats)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+    def _count_statement(self, connect, sql):
+        """
+        Track sql in the connection's LRU of statement texts, the same size as
+        asyncpg's statement cache, and count whether asyncpg had it prepared.
+        """
+        cache = getattr(connect, 'statement_texts', None)
+        if cache is None or not self.statement_cache_size:
+            return
+        if sql in cache:
+            cache.move_to_end(sql)
+            self.statement_stats['hits'] += 1
+            return
+        self.statement_stats['misses'] += 1
+        cache[sql] = None
+        while len(cache) > self.statement_cache_size:
+            cache.popitem(last=False)
+            self.statement_stats['evictions'] += 1
 
     async def _execute(self, sql, args=None, execution_type=MODIFY):
         """
@@ -68,14 +360,10 @@ class PGExecutor(object):
 
         reconnect if connect is closed() or self.connection.closed != 0
         """
-        # if self.connection_pool is None or self.connection_pool.closed:
-
-        connect = await self.get_connection()
-
-        if args:
-            query_data = await connect.fetch(sql, *args)
-        else:
-            query_data = await connect.fetch(sql)
+        async with self.acquire() as connect:
+            # asyncpg prepares sql once per connection and re-prepares it on schema changes
+            self._count_statement(connect, sql)
+            query_data = await connect.fetch(sql, *(args or ()))
 
         print(sql, type(query_data))
         print("query data {}".format(query_data))
@@ -97,6 +385,8 @@ class PGExecutor(object):
         try:
             data = await self._execute(sql, args, FETCH_ONE)
             return data
+        except DatabaseUnavailableError:
+            raise
         except Exception as error:
             print(error)
             return None
@@ -108,6 +398,38 @@ class PGExecutor(object):
         data = await self._execute(sql, args, FETCH_ALL)
         return data
 
+    async def fetch_chunks(self, sql, args=None, chunk_size=CURSOR_PREFETCH):
+        """
+        async for rows in db.fetch_chunks("SELECT ... FROM business", chunk_size=1000):
+            ...
+
+        Reads the result through a server side cursor and yields lists of at
+        most chunk_size records, so memory does not grow with the result size.
+        The pooled connection is held, inside a transaction, until the loop ends.
+        """
+        args = args or ()
+        async with self.acquire() as connect:
+            async with connect.transaction():
+                cursor = await connect.cursor(sql, *args)
+                while True:
+                    rows = await cursor.fetch(chunk_size)
+                    if not rows:
+                        break
+                    yield rows
+                    if len(rows) < chunk_size:
+                        break
+
+    async def iterate_rows(self, sql, args=None, chunk_size=CURSOR_PREFETCH):
+        """
+        async for record in db.iterate_rows("SELECT ... FROM business"):
+            ...
+
+        Same as fetch_chunks, one record at a time.
+        """
+        async for rows in self.fetch_chunks(sql, args, chunk_size):
+            for record in rows:
+                yield record
+
     async def insert_many(self, sql, data_list):
         """
         await rest.insert_many("insert into test values ($1, $2)", [("c", 3) , ("d", 4)])
@@ -115,32 +437,33 @@ class PGExecutor(object):
         :param data_list: [("c", 3) , ("d", 4)]
         :return:
         """
-        connect = await self.get_connection()
-        await connect.executemany(sql, data_list)
+        async with self.acquire() as connect:
+            await connect.executemany(sql, data_list)
 
     async def modify_rows(self, sql, args=None):
         """
         Execute an insert, update or delete statement.
         """
-        connect = await self.get_connection()
-
-        if args:
-            data = await connect.execute(sql, *args)
-        else:
-            data = await connect.execute(sql)
+        async with self.acquire() as connect:
+            if args:
+                self._count_statement(connect, sql)
+                data = await connect.execute(sql, *args)
+            else:
+                # simple query protocol, keeps multi-statement scripts working
+                data = await connect.execute(sql)
         return data
 
     async def copy_to_file(self, sql, file, args=[]):
-        connect = await self.get_connection()
-        result = await connect.copy_from_query(
-         sql, *args, output=file, format='csv')
+        async with self.acquire() as connect:
+            result = await connect.copy_from_query(
+             sql, *args, output=file, format='csv')
         print(result)
 
     async def copy_from_file(self, table_name, schema_name, file):
-        connect = await self.get_connection()
-        with open(file, 'rb') as f:
-            result = await connect.copy_to_table(
-            table_name.lower(), schema_name=schema_name.lower(), source=f, format='csv', header=True)
+        async with self.acquire() as connect:
+            with open(file, 'rb') as f:
+                result = await connect.copy_to_table(
+                table_name.lower(), schema_name=schema_name.lower(), source=f, format='csv', header=True)
         print(result)
         os.remove(file)
 
@@ -0,0 +1,37 @@
+import asyncio
+
+
+class SingleFlight(object):
+    """
+    Collapses concurrent calls for the same key into one.
+
+    rows = await flight.do(key, fetch_rows, sql, args)
+
+    The first caller starts fetch_rows, everyone asking for the same key while it
+    runs awaits that call and shares its result (or its exception). A caller being
+    cancelled does not cancel the shared call.
+    """
+
+    def __init__(self):
+        self.calls = {}
+
+    def __len__(self):
+        return len(self.calls)
+
+    def is_running(self, key):
+        return key in self.calls
+
+    async def do(self, key, coroutine_function, *args, **kwargs):
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(coroutine_function(*args, **kwargs))
+            self.calls[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+        return await asyncio.shield(task)
+
+    def _finish(self, key, task):
+        if self.calls.get(key) is task:
+            del self.calls[key]
+        if not task.cancelled():
+            # mark the exception retrieved when every waiter has gone away
+            task.exception()
@@ -1,8 +1,18 @@
 #! /user/bin/python
 
 # imports
-from collections import namedtuple
+from collections import namedtuple, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from functools import partial
+from io import StringIO
+from string import Formatter
+import asyncio
+import itertools
 import os
+import queue
+import re
+import threading
 import time
 
 import psycopg2
@@ -43,6 +53,55 @@ log.addHandler(NullHandler())
 
 RECONNECT_ATTEMPTS = 10
 
+# rows a named cursor fetches per round trip
+STREAMING_ITERSIZE = 3000
+# suffixes for unique server side cursor names
+cursor_numbers = itertools.count(1)
+
+# BulkDb engines: 'format' writes the values into the sql text, 'values' sends
+# them as parameters through psycopg2.extras.execute_values
+FORMAT_ENGINE = 'format'
+VALUES_ENGINE = 'values'
+# BlockUpdate only: COPY the block into a temp table and update from it
+COPY_ENGINE = 'copy'
+# a template field wrapped in quotes, '{col}' or '{}'
+QUOTED_FIELD = re.compile(r"'(\{[^{}]*\})'")
+
+
+def to_csv_field(value):
+    """
+    COPY csv field: NULL is an empty unquoted field, every other value is quoted
+    so an empty string stays an empty string.
+    """
+    if value is None:
+        return ''
+    return '"' + str(value).replace('"', '""') + '"'
+
+
+def to_parameter_template(template):
+    """
+    Turns a Block template, ({}, '{}') or ({col1}, '{col2}'), into a psycopg2
+    one, (%s, %s), plus the index or key each %s is read from in a data row.
+    Quotes around a field are dropped, psycopg2 quotes the value itself.
+    """
+    template = QUOTED_FIELD.sub(r'\1', template)
+    parts = []
+    keys = []
+    auto_index = 0
+    for literal, field, _, _ in Formatter().parse(template):
+        parts.append(literal.replace('%', '%%'))
+        if field is None:
+            continue
+        if field == '':
+            keys.append(auto_index)
+            auto_index += 1
+        elif field.isdigit():
+            keys.append(int(field))
+        else:
+            keys.append(field)
+        parts.append('%s')
+    return ''.join(parts), tuple(keys)
+
 
 
 
@@ -50,18 +109,20 @@ class Block(object):
     _sql = None
     _values = None
 
-    def __init__(self, db, header, template, data, ret=False):
+    def __init__(self, db, header, template, data, ret=False, engine=FORMAT_ENGINE):
         """
 
         :param db:
         :param header: is '''insert into table(col1,col2)'''
         :param template: is '''({} , {})''' or '''({col1} , {col2})'''
         :param data: list of list or list of dict
+        :param engine: FORMAT_ENGINE or VALUES_ENGINE
         """
         self.db = db
         self.header = header
         self.template = template
         self.data = data
+        self.engine = engine
 
         self.return_values = None
         self.ret = ret
@@ -89,12 +150,25 @@ class Block(object):
 
         return self.header + ' values ' + self.values
 
+    @property
+    def parameter_sql(self):
+        """
+        sql for execute_values, %s stands for the VALUES list.
+        """
+        sql = self.header + ' values %s' + ON_CONFLICT
+        if self.ret is True:
+            return sql + " RETURNING id "
+        return sql
+
     @property
     def set_statement(self):
         raise NotImplementedError
 
     def execute(self):
         # print (self.sql)
+        if self.engine == VALUES_ENGINE:
+            return self.execute_values()
+
         if self.ret is True:
             self.return_values = self.db.fetch_all_rows(self.sql).query_data
         else:
@@ -102,6 +176,13 @@ class Block(object):
 
         return self.return_values
 
+    def execute_values(self):
+        template, keys = to_parameter_template(self.template)
+        args = [tuple(instance[key] for key in keys) for instance in self.data]
+        self.return_values = self.db.execute_values(self.parameter_sql, args, template=template,
+                                                    page_size=len(args), fetch=self.ret)
+        return self.return_values
+
     def is_dict(self):
         if isinstance(self.data[0], dict):
             is_dict = True
@@ -113,14 +194,17 @@ class Block(object):
 
 
 class BlockUpdate(Block):
-    def __init__(self, db, header, template, data, keys, update_cols=None, ret=False):
+    def __init__(self, db, header, template, data, keys, update_cols=None, ret=False, engine=FORMAT_ENGINE,
+                 upsert=False):
 
-        Block.__init__(self, db, header, template, data, ret=ret)
+        Block.__init__(self, db, header, template, data, ret=ret, engine=engine)
 
+        self.table_name = self.header.split()[-1]
         self.header = self.header + ' update_tb '
         self.keys = keys
         self.update_cols = update_cols
         self.ret = ret
+        self.upsert = upsert
 
         assert isinstance(keys, list), 'Must provide list of keys for update'
 
@@ -197,6 +281,74 @@ class BlockUpdate(Block):
                self.values + self.data_statement + \
                self.conditional_statement
 
+    def execute(self):
+        if self.engine == COPY_ENGINE:
+            return self.execute_copy()
+        return Block.execute(self)
+
+    @property
+    def copy_columns(self):
+        return list(self.data[0].keys())
+
+    @property
+    def merge_sql(self):
+        """
+        UPDATE (or with upsert, INSERT ... ON CONFLICT) from the staging table.
+        """
+        if self.update_cols is None:
+            self.update_cols = [col for col in self.data[0] if col not in self.keys]
+        columns = ','.join(self.copy_columns)
+
+        if self.upsert:
+            sql = 'INSERT INTO {table} ({columns}) SELECT {columns} FROM {staging} ON CONFLICT ({keys}) '.format(
+                table=self.table_name, columns=columns, staging=self.staging_table, keys=','.join(self.keys))
+            if self.update_cols:
+                sql += 'DO UPDATE SET ' + ','.join('{col}=EXCLUDED.{col}'.format(col=col) for col in self.update_cols)
+            else:
+                sql += 'DO NOTHING'
+            if self.ret is True:
+                sql += ' RETURNING ' + columns
+            return sql
+
+        sql = 'UPDATE {table} update_tb SET {updates} FROM {staging} data WHERE {conditions}'.format(
+            table=self.table_name, staging=self.staging_table,
+            updates=','.join('{col}=data.{col}'.format(col=col) for col in self.update_cols),
+            conditions=' AND '.join('update_tb.{key}=data.{key}'.format(key=key) for key in self.keys))
+        if self.ret is True:
+            sql += ' RETURNING ' + ','.join('update_tb.{}'.format(col) for col in self.copy_columns)
+        return sql
+
+    def execute_copy(self):
+        """
+        COPY the block as csv into a temp table, then one UPDATE ... FROM or
+        INSERT ... ON CONFLICT statement, all in a single transaction.
+        """
+        self.staging_table = 'bulk_update_{}'.format(next(cursor_numbers))
+        columns = self.copy_columns
+        copy_file = StringIO()
+        for instance in self.data:
+            copy_file.write(','.join(to_csv_field(instance[col]) for col in columns))
+            copy_file.write('\n')
+        copy_file.seek(0)
+
+        with self.db.transaction():
+            self.db.modify_rows('CREATE TEMP TABLE {staging} ON COMMIT DROP AS SELECT {columns} FROM {table} '
+                                'WITH NO DATA'.format(staging=self.staging_table, columns=','.join(columns),
+                                                      table=self.table_name))
+            self.db.copy_from_buffer('COPY {staging} ({columns}) FROM STDIN WITH (FORMAT csv)'.format(
+                staging=self.staging_table, columns=','.join(columns)), copy_file)
+            if self.ret is True:
+                self.return_values = self.db.fetch_all_rows(self.merge_sql).query_data
+            else:
+                self.db.modify_rows(self.merge_sql)
+        return self.return_values
+
+    @property
+    def parameter_sql(self):
+        return self.header + self.set_statement +\
+               ' (VALUES %s) ' + self.data_statement + \
+               self.conditional_statement
+
 
 class BlockList(Block):
     def __init__(self, db, header, template, data, ret=False):
@@ -220,15 +372,129 @@ class BlockList(Block):
 
 
 
+def iterate_blocks(data, block):
+    """
+    Splits data, a list or any iterable, into lists of at most block rows.
+    """
+    iterator = iter(data)
+    while True:
+        rows = list(itertools.islice(iterator, block))
+        if not rows:
+            return
+        yield rows
+
+
 class BulkDb(object):
 
     _divider = None
 
-    def __init__(self, db):
+    def __init__(self, db, engine=FORMAT_ENGINE, workers=1, transaction=False, ordered=True):
+        """
+        engine=VALUES_ENGINE sends every block as one parameterized statement
+        through execute_values instead of formatting the values into the sql.
+        Templates stay the same, quotes around fields are dropped.
+
+        workers > 1 runs that many blocks at once, each on its own connection
+        (db plus workers - 1 more PgsqlExecutor with the same config), with at
+        most 2 * workers blocks read ahead from data. transaction=True commits
+        every block on its own, a failing block is rolled back alone. Blocks
+        on the extra connections are committed on their own anyway when db is
+        not in autocommit mode, only db itself is left for the caller to commit.
+        ordered=False returns RETURNING rows in completion order, not block order.
+
+        with BulkDb(db, workers=4) as bulk_db:
+            bulk_db.insert(...)
+        closes the extra connections on exit.
+        """
         self.db = db
+        self.engine = engine
+        self.workers = max(1, workers)
+        self.transaction = transaction
+        self.ordered = ordered
+        self.pool = None
+        self._pool_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def get_pool(self):
+        """
+        Opens the worker connections once, even when worker threads ask at the same time.
+        """
+        with self._pool_lock:
+            if self.pool is None:
+                pool = queue.Queue()
+                pool.put(self.db)
+                for _ in range(self.workers - 1):
+                    pool.put(PgsqlExecutor(self.db.config, auto_commit=self.db.auto_commit))
+                self.pool = pool
+            return self.pool
+
+    def close(self):
+        """
+        Closes the extra worker connections, db is left open.
+        """
+        with self._pool_lock:
+            pool, self.pool = self.pool, None
+        if pool is None:
+            return
+        while not pool.empty():
+            db = pool.get()
+            if db is not self.db:
+                db.close()
+
+    def run_block(self, make_block, rows):
+        pool = self.get_pool()
+        db = pool.get()
+        try:
+            # nobody else could commit a worker connection
+            if self.transaction or (db is not self.db and not db.connection.autocommit):
+                with db.transaction():
+                    return make_block(db, rows).execute()
+            return make_block(db, rows).execute()
+        finally:
+            pool.put(db)
 
+    def run_blocks(self, make_block, data, block):
+        """
+        Executes make_block(db, rows).execute() for every block of data and
+        returns their results.
+        """
+        results = []
+        blocks = iterate_blocks(data, block)
+        if self.workers == 1:
+            for rows in blocks:
+                results.append(self.run_block(make_block, rows))
+            return results
+
+        # opened before the first submit, the workers only take connections from it
+        self.get_pool()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = deque()
+            for rows in blocks:
+                if len(pending) >= 2 * self.workers:
+                    results.extend(self.wait_blocks(pending))
+                pending.append(executor.submit(self.run_block, make_block, rows))
+            while pending:
+                results.extend(self.wait_blocks(pending))
+        return results
 
-    def update(self, header, template, data, keys, update_cols=None, ret=False, block=3000):
+    def wait_blocks(self, pending):
+        """
+        Removes finished futures from pending and returns their results: the
+        oldest one when ordered, else whichever completed first.
+        """
+        if self.ordered:
+            return [pending.popleft().result()]
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            pending.remove(future)
+        return [future.result() for future in done]
+
+    def update(self, header, template, data, keys, update_cols=None, ret=False, block=3000, upsert=False):
         """
         :param data: data must be list or iter
         header = '''Update test'''
@@ -237,34 +503,20 @@ class BulkDb(object):
         ret_data = bulk_insert.update(header=header, template=template,
                     data=update_list, keys=['id'],
                     update_cols= ['col2'],block=10, ret=True)
-        """
-        assert isinstance(data, list), "Data must be a list"
 
-        divider = len(data) // block
-        start = 0
-        end = 0
-
-        return_values = None
+        With engine=COPY_ENGINE the rows (dicts) are copied into a temp table and
+        merged from there, the template is not used. upsert=True inserts the rows
+        that have no match on keys, which then need a unique index.
+        """
+        def make_block(db, rows):
+            return BlockUpdate(db=db, header=header, template=template, data=rows,
+                               keys=keys, update_cols=update_cols, ret=ret, engine=self.engine,
+                               upsert=upsert)
 
+        results = self.run_blocks(make_block, data, block)
         if ret is True:
-            return_values = []
-
-        for index in range(0, divider + 1):
-            end = start + block
-            if end >= len(data):
-                end = len(data)
-            if start == end:
-                continue
-
-            exec_block = BlockUpdate(db=self.db, header=header, template=template, data=data[start:end],
-                                     keys=keys, update_cols=update_cols, ret=ret)
-            if ret is True:
-                return_values += exec_block.execute()
-            else:
-                exec_block.execute()
-            start = end
-
-        return return_values
+            return [row for result in results for row in result]
+        return None
 
     def insert_list(self, header, template, data, block=3000):
         """
@@ -277,24 +529,11 @@ class BulkDb(object):
         bulk_insert = BulkDb(db=db3 )
         bulk_insert.insert(header=header, template=template, data=list_data, block=10)
         """
-        assert isinstance(data, list), "Data must be a list"
-
-        divider = len(data) // block
-        start = 0
-        end = 0
-        return_values = None
-        for index in range(0, divider + 1):
-            end = start + block
-            if end >= len(data):
-                end = len(data)
-            if start == end:
-                continue
-            exec_block = BlockList(db=self.db, header=header, template=template, data=data[start:end])
-            exec_block.execute()
-            start = end
-        return return_values
-
+        def make_block(db, rows):
+            return BlockList(db=db, header=header, template=template, data=rows)
 
+        self.run_blocks(make_block, data, block)
+        return None
 
     def insert(self, header, template, data, block=3000, ret=False):
         """
@@ -312,29 +551,14 @@ class BulkDb(object):
         bulk_insert = BulkDb(db=db3)
         ret_data = bulk_insert.insert(header=header, template=template, data=list_data, block=10, ret=True)
         """
-        assert isinstance(data, list), "Data must be a list"
+        def make_block(db, rows):
+            return Block(db=db, header=header, template=template, data=rows, ret=ret, engine=self.engine)
 
-        divider = len(data) // block
-        start = 0
-        end = 0
-        return_values = None
+        results = self.run_blocks(make_block, data, block)
         if ret is True:
-            return_values = []
-
-        for index in range(0, divider + 1):
-
-            end = start + block
-            if end >= len(data):
-                end = len(data)
-            if start == end:
-                continue
-            exec_block = Block(db=self.db, header=header, template=template, data=data[start:end], ret=ret)
-            if ret is True:
-                return_values += exec_block.execute()
-            else:
-                exec_block.execute()
-            start = end
-        return return_values
+            return [row for result in results for row in result]
+        return None
+
 
 class PgsqlExecutor(object):
     """
@@ -350,6 +574,7 @@ class PgsqlExecutor(object):
         self.cursor = None
         self.connection = None
         self.auto_commit = auto_commit
+        self.in_transaction = False
         self.__connect__()
 
     def __connect__(self):
@@ -487,27 +712,82 @@ class PgsqlExecutor(object):
 
         # return result
 
-    def streaming_cursor(self, sql, args=None):
+    @contextmanager
+    def transaction(self):
+        """
+        with db.transaction():
+            db.modify_rows(...)
+
+        Commits on exit and rolls back when the block raises. An autocommit
+        connection is switched out of autocommit meanwhile; psycopg2 refuses to
+        change it inside an open transaction, so it is left alone otherwise.
+        """
+        if self.in_transaction:
+            # nested, the outer block commits
+            yield self
+            return
+        if self.connection.closed != 0:
+            self.__connect__()
+        auto_commit = self.connection.autocommit
+        if auto_commit:
+            self.connection.autocommit = False
+        self.in_transaction = True
+        try:
+            with self.connection:
+                yield self
+        finally:
+            self.in_transaction = False
+            if auto_commit and not self.connection.closed:
+                self.connection.autocommit = True
+
+    def execute_values(self, sql, argslist, template=None, page_size=100, fetch=False):
+        """
+        Runs sql, which holds a single %s for a VALUES list, once per page_size
+        rows of argslist with psycopg2.extras.execute_values.
+
+        :param template: A string like '(%s, %s)' each row is rendered with
+        :param fetch: Return the rows of a RETURNING clause, as named tuples
+        """
+        if self.connection.closed != 0:
+            self.__connect__()
+
+        with self.connection.cursor(cursor_factory=extras.NamedTupleCursor) as cursor:
+            result = extras.execute_values(cursor, sql, argslist, template=template,
+                                           page_size=page_size, fetch=fetch)
+        if fetch:
+            return result
+        return None
+
+    def streaming_cursor(self, sql, args=None, itersize=STREAMING_ITERSIZE, cursor_name=None):
         """
         Generator function that executes a server side cursor.
         Minimize the burden of fetchall in a query that might return a large volume
 
-        :param cursor_name: A string representing the name passed to the server side cursor
         :param sql: A string representing the sql statment to be executed
         :param args: A dictionary or sequence representing the arguments passed to the sql statement
-        """
+        :param itersize: Number of rows fetched from the server per round trip
+        :param cursor_name: A string representing the name passed to the server side cursor
 
-        with self.connection as cxn:
-            with cxn.cursor() as cursor:
-                cursor.arraysize = 3000
-                log.debug(cursor.mogrify(sql, args))
-                cursor.execute(sql, args)
-                while True:
-                    result_set = cursor.fetchmany()
-                    if not result_set:
-                        break
-                    for row in result_set:
+        A named cursor only lives inside a transaction. On an autocommit
+        connection autocommit is switched off while the generator runs and
+        restored when it finishes or is closed, otherwise the cursor is declared
+        in the transaction already open.
+        """
+        cursor_name = cursor_name or 'streaming_cursor_{}'.format(next(cursor_numbers))
+        auto_commit = self.connection.autocommit
+        if auto_commit:
+            self.connection.autocommit = False
+        try:
+            with self.connection as cxn:
+                with cxn.cursor(name=cursor_name) as cursor:
+                    cursor.itersize = itersize
+                    log.debug(cursor.mogrify(sql, args))
+                    cursor.execute(sql, args)
+                    for row in cursor:
                         yield row
+        finally:
+            if auto_commit and not self.connection.closed:
+                self.connection.autocommit = True
 
     def roll_back(self):
         self.cursor.rollback()
@@ -515,6 +795,16 @@ class PgsqlExecutor(object):
     def close(self):
         self.connection.close()
 
+    def copy_from_buffer(self, sql_input, copy_buffer):
+        """
+        Runs a COPY ... FROM STDIN statement reading from a file-like object,
+        the caller commits.
+        """
+        if self.connection.closed != 0:
+            self.__connect__()
+        with self.connection.cursor() as cursor:
+            cursor.copy_expert(sql_input, copy_buffer)
+
     def copy_edit_from_file(self, sql_input, copy_file):
         """
         This copy function provides user a powerful tool to copy data to database
@@ -620,6 +910,42 @@ class PgsqlExecutor(object):
         return "database: {database} - User: {user} - Host: {host} - Port: {port}".format(**self.config)
 
 
+class AsyncPgsqlExecutor(object):
+    """
+    Runs a blocking PgsqlExecutor on a worker thread so async handlers that must
+    stay on psycopg2 do not stall the event loop.
+
+    static_db = AsyncPgsqlExecutor(PgsqlExecutor(config))
+    result = await static_db.fetch_one_row(sql, args, dict_cursor=True)
+
+    A psycopg2 connection runs one statement at a time, so the default is a
+    single worker thread per executor.
+    """
+    def __init__(self, executor, max_workers=1):
+        self.executor = executor
+        self.thread_pool = ThreadPoolExecutor(max_workers=max_workers)
+
+    async def run(self, func, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.thread_pool, partial(func, *args, **kwargs))
+
+    async def fetch_one_row(self, sql, args=None, dict_cursor=False):
+        return await self.run(self.executor.fetch_one_row, sql, args, dict_cursor)
+
+    async def fetch_all_rows(self, sql, args=None, dict_cursor=False):
+        return await self.run(self.executor.fetch_all_rows, sql, args, dict_cursor)
+
+    async def modify_rows(self, sql, args=None):
+        return await self.run(self.executor.modify_rows, sql, args)
+
+    async def get_dataframe(self, sql, args=None):
+        return await self.run(self.executor.get_dataframe, sql, args)
+
+    def close(self):
+        self.thread_pool.shutdown(wait=True)
+        self.executor.close()
+
+
 def copy_table_fromdb_todb(table_name, from_db, to_db):
     """
     This function is used to copy across databases
@@ -0,0 +1,173 @@
+import asyncio
+import json
+import logging
+import time
+import traceback
+from collections import deque
+
+
+class NullHandler(logging.Handler):
+    def emit(self, record):
+        pass
+
+log = logging.getLogger('Telemetry')
+log.addHandler(NullHandler())
+
+TELEMETRY_MAX_QUEUE = 10000
+TELEMETRY_BATCH_SIZE = 100
+TELEMETRY_FLUSH_INTERVAL = 5
+
+# Event types
+EXCEPTION = 'exception'
+EVENT = 'event'
+
+
+class NullSink(object):
+    """
+    Drops every event, for tests and local runs.
+    """
+    async def send(self, events):
+        pass
+
+
+class FileSink(object):
+    """
+    Appends events to path as JSON lines.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, events):
+        with open(self.path, 'a') as telemetry_file:
+            for event in events:
+                record = {key: value for key, value in event.items() if key != 'exc_info'}
+                if event.get('exc_info'):
+                    record['traceback'] = ''.join(traceback.format_exception(*event['exc_info']))
+                telemetry_file.write(json.dumps(record, default=str) + '\n')
+
+    async def send(self, events):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.write, events)
+
+
+class ApplicationInsightsSink(object):
+    """
+    Sends events through an applicationinsights TelemetryClient. The client
+    posts synchronously, so a batch is tracked and flushed on a worker thread.
+    """
+    def __init__(self, client):
+        self.client = client
+
+    def write(self, events):
+        for event in events:
+            if event['type'] == EXCEPTION:
+                self.client.track_exception(*event['exc_info'], properties=event['properties'])
+            else:
+                self.client.track_event(event['name'], properties=event['properties'])
+        self.client.flush()
+
+    async def send(self, events):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.write, events)
+
+
+def get_sink(name, client=None, path='telemetry.log'):
+    if name == 'appinsights' and client is not None:
+        return ApplicationInsightsSink(client)
+    if name == 'file':
+        return FileSink(path)
+    return NullSink()
+
+
+class TelemetryPipeline(object):
+    """
+    Queues telemetry in memory and sends it to sink in batches from a background
+    task, every flush_interval seconds or as soon as batch_size events are
+    waiting. Handlers only pay for an append.
+
+    The queue holds at most max_queue events, new events are dropped (and
+    counted) while it is full. Coroutine functions added with add_flush_hook,
+    such as the aiohttp ai_client's flush, run after every batch round.
+    """
+
+    def __init__(self, sink, max_queue=TELEMETRY_MAX_QUEUE, batch_size=TELEMETRY_BATCH_SIZE,
+                 flush_interval=TELEMETRY_FLUSH_INTERVAL):
+        self.sink = sink
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = deque()
+        self.flush_hooks = []
+        self.stats = {'queued': 0, 'sent': 0, 'dropped': 0, 'failed': 0}
+        self.task = None
+        self.wakeup = None
+
+    def add_flush_hook(self, hook):
+        self.flush_hooks.append(hook)
+
+    def track_exception(self, exc_type, value, tb, properties=None):
+        # the queued traceback only has to print, drop the locals of its frames so
+        # they are not kept alive until the next flush
+        if tb is not None:
+            traceback.clear_frames(tb)
+        return self.put({'type': EXCEPTION, 'name': exc_type.__name__ if exc_type else None,
+                         'exc_info': (exc_type, value, tb), 'properties': properties or {},
+                         'time': time.time()})
+
+    def track_event(self, name, properties=None):
+        return self.put({'type': EVENT, 'name': name, 'properties': properties or {}, 'time': time.time()})
+
+    def put(self, event):
+        if len(self.queue) >= self.max_queue:
+            self.stats['dropped'] += 1
+            return False
+        self.queue.append(event)
+        self.stats['queued'] += 1
+        if self.wakeup is not None and len(self.queue) >= self.batch_size:
+            self.wakeup.set()
+        return True
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['pending'] = len(self.queue)
+        return stats
+
+    async def flush(self):
+        while self.queue:
+            batch = [self.queue.popleft() for _ in range(min(self.batch_size, len(self.queue)))]
+            try:
+                await self.sink.send(batch)
+                self.stats['sent'] += len(batch)
+            except Exception as error:
+                self.stats['failed'] += len(batch)
+                log.warning('Could not send {} telemetry events: {}'.format(len(batch), error))
+
+        for hook in self.flush_hooks:
+            try:
+                await hook()
+            except Exception as error:
+                log.warning('Telemetry flush hook failed: {}'.format(error))
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        if self.task is None:
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.flush()
@@ -1,46 +1,102 @@
 import re
 from functools import wraps
-from main.config import tc, AUTH_TOKEN, db, static_db
+from main.config import telemetry, AUTH_TOKEN, db, static_db, auth_cached
 import sys
 import traceback
 from aiohttp import web
 import json
 from mapper.business import MapperBusiness
-from lib.pg_executor import PGExecutor
+from mapper.session import MapperSession, SessionTokenIndex
+from lib.pg_executor import PGExecutor, DatabaseUnavailableError
 import base64
+import binascii
+import hashlib
 from lib.hash_password import hash_password
 
 
 mapper_business = MapperBusiness(db, static_db)
+mapper_session = MapperSession(db, static_db, mapper_business)
+token_index = SessionTokenIndex(mapper_session)
+
+# business id -> digests of the Authorization headers cached for it
+auth_digests = {}
+
+
+def get_credential_digest(authorization):
+    return hashlib.sha256(authorization.encode('utf-8')).hexdigest()
+
+
+def cache_authenticated(digest, business_dto):
+    auth_cached.set_cache(digest, dict(business_dto))
+    digests = auth_digests.setdefault(business_dto.id, set())
+    # forget digests the cache has already expired or evicted
+    digests.intersection_update(auth_cached.data)
+    digests.add(digest)
+
+
+def invalidate_business(business_id):
+    """
+    Drop every cached credential of a business, called when its password or role changes.
+    """
+    for digest in auth_digests.pop(business_id, ()):
+        auth_cached.delete_cache(digest)
 
 
 async def get_authenticate(request):
-    print(request.headers)
     if 'Authorization' in request.headers.keys():
         request.business = None
-        access_token = request.headers['Authorization']
-        access_token = re.sub('Bearer', '', access_token)
-        if access_token.strip() == AUTH_TOKEN:
+        authorization = request.headers['Authorization']
+        access_token = re.sub('Bearer', '', authorization).strip()
+        # session tokens are checked against the index every time, it knows their expiry
+        business_id = await token_index.lookup(access_token)
+        if business_id is not None:
+            business_dto = mapper_business.get_dto(id=business_id)
+            request.business = await mapper_business.select_business(business_dto)
+            return 'valid' if request.business else 'invalid'
+
+        digest = get_credential_digest(authorization)
+        cached = auth_cached.get_cache(digest)
+        if cached:
+            request.business = mapper_business.get_dto(**cached)
+            return 'valid'
+
+        if access_token == AUTH_TOKEN:
             business_dto = mapper_business.get_dto(id=1)
             request.business = await mapper_business.select_business(business_dto)
+            if request.business:
+                cache_authenticated(digest, request.business)
             return 'valid'
-        access_token = re.sub("Basic", "", request.headers['Authorization']).strip()
+        access_token = re.sub("Basic", "", authorization).strip()
         message = access_token.encode('utf-8')
-        base64_bytes = base64.b64decode(message)
-        username, password = base64_bytes.split(b':')
+        try:
+            base64_bytes = base64.b64decode(message)
+            username, password = base64_bytes.split(b':', 1)
+            username = username.decode('utf-8')
+        except (binascii.Error, ValueError):
+            return "invalid"
 
-        business_dto = mapper_business.get_dto(username=username.decode('utf-8'))
+        business_dto = mapper_business.get_dto(username=username)
         business_dto = await mapper_business.select_business(business_dto, where_column='username')
 
-        print(type(password), password)
-
-        if hash_password(password) == business_dto.password:
-            print("correct")
+        if business_dto and hash_password(password) == business_dto.password:
             request.business = business_dto
+            cache_authenticated(digest, business_dto)
             return 'valid'
     return "invalid"
 
 
+async def start_token_index(app):
+    try:
+        await token_index.warm()
+    except Exception as error:
+        print('Error Occured at Session Token Index Loading {}'.format(error))
+    token_index.start()
+
+
+async def stop_token_index(app):
+    await token_index.stop()
+
+
 def authenticate(f):
     @wraps(f)
     async def wrapped(request, *args, **kwargs):
@@ -51,6 +107,9 @@ def authenticate(f):
         try:
             value = await f(request, *args, **kwargs)
             return value
+        except DatabaseUnavailableError:
+            # answered with a 503 by db_unavailable_middleware
+            raise
         except Exception as error:
             exc_info = sys.exc_info()
             traceback.print_exception(*exc_info)
@@ -58,8 +117,7 @@ def authenticate(f):
                           'type': str(traceback.format_exc(limit=3)),
                           "error": str(error),
                           'problem Id': 'OCR api {}'.format(f)}
-            tc.track_exception(*sys.exc_info(), properties=properties)
-            tc.flush()
+            telemetry.track_exception(*sys.exc_info(), properties=properties)
             return web.Response(text=json.dumps(properties), status=500)
 
     return wrapped
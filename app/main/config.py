@@ -5,6 +5,7 @@ from azure.identity import DefaultAzureCredential
 from lib.cache_data import CacheData
 from lib.static_db import PgsqlExecutor
 from lib.pg_executor import PGExecutor
+from lib.telemetry import TelemetryPipeline, get_sink
 
 import sys
 
@@ -12,6 +13,9 @@ key_vault_uri = "https://thachstockservers.vault.azure.net/"
 instrumentation_key = "08121580-af3e-4f86-8680-3a83210704b0"
 
 tc = TelemetryClient(instrumentation_key)
+# TELEMETRY_SINK=file|none keeps telemetry off Application Insights, e.g. for tests
+telemetry = TelemetryPipeline(get_sink(os.environ.get("TELEMETRY_SINK", "appinsights"), tc,
+                                       os.environ.get("TELEMETRY_FILE", "telemetry.log")))
 
 credential = DefaultAzureCredential()
 
@@ -19,7 +23,10 @@ keyVaultName = os.environ["KEY_VAULT_NAME"]
 
 KVUri = "https://" + keyVaultName + ".vault.azure.net"
 
-sql_cached = CacheData(max_cache_number=100000, cache_time=1000)
+# mapper writes keep this coherent within the process, the TTL bounds staleness from other replicas
+sql_cached = CacheData(max_cache_number=100000, cache_time=60 * 60, frozen=True)
+# verified Authorization header digest -> business row
+auth_cached = CacheData(max_cache_number=10000, cache_time=300, frozen=True)
 
 
 try :
@@ -50,4 +57,5 @@ test_db = dict(
 )
 
 static_db = PgsqlExecutor(test_db)
-db = PGExecutor(username=DB_USER, password=DB_PASSWORD, host=DSN_HOST, port=DB_PORT, database=DB_NAME)
\ No newline at end of file
+db = PGExecutor(username=DB_USER, password=DB_PASSWORD, host=DSN_HOST, port=DB_PORT, database=DB_NAME,
+                use_pool=True, min_size=5, max_size=20)
\ No newline at end of file
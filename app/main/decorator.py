@@ -1,21 +1,18 @@
 import simplejson as json
 import csv
+import re
+import traceback
 from io import StringIO, BytesIO
-from functools import wraps
+from functools import wraps, partial, lru_cache
 from datetime import datetime, date, timedelta
-from mapper.base import Dto, DtoError, DtoType, Null
+from mapper.base import Dto, DtoError, DtoType, DtoTimestamp, DtoDate, Null
 from lib import date_ext
-from pytz import utc, timezone
+from aiohttp import web
+from main.serializer import format_datetime, json_dumps_bytes
 
 
 def convert_timezone(o, user_timezone):
-    tz = timezone(user_timezone)
-    try:
-        o = o.astimezone(tz)
-    except:
-        o = o.replace(tzinfo=utc)
-        o = o.astimezone(tz)
-    return o.isoformat()
+    return format_datetime(o, user_timezone)
 
 
 class CustomEncoder(json.JSONEncoder):
@@ -42,17 +39,55 @@ class CustomEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, o)
 
 
+# cheap screen before any date parsing, strings not starting with YYYY-MM-DD are left alone
+ISO_DATE_PREFIX = re.compile(r'\d{4}-\d{2}-\d{2}')
+
+
 def convert_str_to_date(date_string):
-    if len(date_string) < 4:
+    if not isinstance(date_string, str) or not ISO_DATE_PREFIX.match(date_string):
         raise TypeError()
-    try:
-        float(date_string)
-    except (ValueError, TypeError):
-        return date_ext.parse_isoformat(date_string)
-    raise TypeError()  # if a number can be converted to a float then do not cast it into a date
+    return date_ext.parse_isoformat(date_string)
+
+
+@lru_cache(maxsize=None)
+def get_date_parsers(DtoClass):
+    """
+    Column name -> parser for the timestamp and date columns of DtoClass.
+    """
+    prototype = DtoClass()
+    parsers = {}
+    for attr in prototype.attributes:
+        attr_type = prototype._attr_type[attr]
+        if isinstance(attr_type, DtoTimestamp):
+            parsers[attr] = date_ext.parse_isoformat
+        elif isinstance(attr_type, DtoDate):
+            parsers[attr] = date_ext.parse_isodate
+    return parsers
 
 
 class CustomDecoder(json.JSONDecoder):
+    """
+    With dto_class, only the timestamp and date columns of that class are
+    parsed, in the top level object or in each object of a top level list.
+    Without it every string that looks like an ISO date is parsed.
+    """
+    def __init__(self, *args, dto_class=None, **kwargs):
+        json.JSONDecoder.__init__(self, *args, **kwargs)
+        self.date_parsers = get_date_parsers(dto_class) if dto_class is not None else None
+
+    def decode_dto(self, o):
+        if isinstance(o, list):
+            return [self.decode_dto(element) for element in o]
+        if isinstance(o, dict):
+            for key, parser in self.date_parsers.items():
+                value = o.get(key)
+                if isinstance(value, str):
+                    try:
+                        o[key] = parser(value)
+                    except (ValueError, OverflowError):
+                        pass
+        return o
+
     def decode_data(self, o):
         if isinstance(o, list):
             for index, element in enumerate(o):
@@ -75,8 +110,17 @@ class CustomDecoder(json.JSONDecoder):
 
     def decode(self, s):
         o = json.JSONDecoder.decode(self, s)
+        if self.date_parsers is not None:
+            return self.decode_dto(o)
         return self.decode_data(o)
 
+
+def get_json_loads(dto_class=None):
+    """
+    loads function for aiohttp's request.json(loads=...).
+    """
+    return partial(json.loads, cls=CustomDecoder, dto_class=dto_class)
+
 #
 # def geojson_format(f):
 #     @wraps(f)
@@ -157,23 +201,26 @@ def json_format_result(result):
 #     return geojson.dumps(result)  # , cls=CustomEncoder, encoding='utf-8')
 
 
+# rows written per response.write() when streaming an export
+EXPORT_BATCH_ROWS = 500
+
+
 def csv_format(f):
+    """
+    Handlers get the request body as a csv reader and their result is sent back as csv.
+    """
     @wraps(f)
-    def wrapper(self, request, *args, **kwargs):
+    async def wrapper(request, *args, **kwargs):
         try:
-            content = csv.reader(request.content)
+            content = csv.reader(StringIO(await request.text()))
         except ValueError:
             content = None
-        val = f(self, request, content, *args, **kwargs)
-        if isinstance(val, defer.Deferred):
-            val.addCallback(csv_format_result, request)
-            return val
-        return csv_format_result(val, request)
+        val = await f(request, content, *args, **kwargs)
+        return web.Response(text=csv_format_result(val), content_type='text/csv')
     return wrapper
 
 
-def csv_format_result(result, request):
-    request.setHeader('Content-Type', 'text/csv')
+def csv_format_result(result):
     csv_file = StringIO()
     try:
         fieldnames = sorted(dict(result[0]).keys())
@@ -187,3 +234,96 @@ def csv_format_result(result, request):
     result = csv_file.getvalue()
     csv_file.close()
     return result
+
+
+def get_csv_value(value):
+    if isinstance(value, datetime):
+        return format_datetime(value)
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, timedelta):
+        return date_ext.totalseconds(value)
+    if isinstance(value, Null):
+        return None
+    return value
+
+
+async def iterate_batches(rows, batch_rows=EXPORT_BATCH_ROWS):
+    """
+    Groups rows, an async iterator or a plain iterable, into lists of batch_rows.
+    """
+    batch = []
+    if hasattr(rows, '__aiter__'):
+        async for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_rows:
+                yield batch
+                batch = []
+    else:
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_rows:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+async def prepare_stream(request, content_type, filename=None):
+    response = web.StreamResponse()
+    response.content_type = content_type
+    if filename:
+        response.headers['Content-Disposition'] = 'attachment; filename="{}"'.format(filename)
+    await response.prepare(request)
+    return response
+
+
+def abort_stream(request, response):
+    """
+    The status line is already sent once a stream fails, so no error response can
+    follow: log the error and drop the connection without the final chunk, the
+    client then sees a truncated body instead of a complete looking export.
+    """
+    traceback.print_exc()
+    if request.transport is not None:
+        request.transport.close()
+    return response
+
+
+async def stream_csv_response(request, columns, rows, filename=None):
+    """
+    Writes rows (records, dicts or dtos) as csv, one batch at a time, so the
+    export never holds more than EXPORT_BATCH_ROWS rows in memory.
+    """
+    response = await prepare_stream(request, 'text/csv', filename)
+    csv_file = StringIO()
+    writer = csv.writer(csv_file, quoting=csv.QUOTE_NONNUMERIC)
+    writer.writerow(columns)
+    try:
+        async for batch in iterate_batches(rows):
+            for row in batch:
+                values = row.__dict__ if isinstance(row, Dto) else row
+                writer.writerow([get_csv_value(values.get(column)) for column in columns])
+            await response.write(csv_file.getvalue().encode('utf-8'))
+            csv_file.seek(0)
+            csv_file.truncate()
+        if csv_file.tell():
+            await response.write(csv_file.getvalue().encode('utf-8'))
+        await response.write_eof()
+    except Exception:
+        return abort_stream(request, response)
+    return response
+
+
+async def stream_ndjson_response(request, rows, filename=None):
+    """
+    Writes rows as newline delimited json, one object per line, in batches.
+    """
+    response = await prepare_stream(request, 'application/x-ndjson', filename)
+    try:
+        async for batch in iterate_batches(rows):
+            await response.write(b''.join(json_dumps_bytes(row) + b'\n' for row in batch))
+        await response.write_eof()
+    except Exception:
+        return abort_stream(request, response)
+    return response
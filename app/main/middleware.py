@@ -0,0 +1,15 @@
+from aiohttp import web
+from lib.pg_executor import DatabaseUnavailableError
+
+
+@web.middleware
+async def db_unavailable_middleware(request, handler):
+    """
+    Turn DatabaseUnavailableError into a quick 503 so clients back off instead of
+    waiting on a database that is known to be down.
+    """
+    try:
+        return await handler(request)
+    except DatabaseUnavailableError as error:
+        return web.Response(text="database unavailable", status=503,
+                            headers={'Retry-After': str(error.retry_after)})
@@ -2,7 +2,12 @@ import psycopg2
 from datetime import datetime, date, timedelta
 import random
 import json
+import asyncio
+import logging
 from main.config import sql_cached
+from lib.single_flight import SingleFlight
+
+log = logging.getLogger(__name__)
 
 class BulkVar(object):
     def __init__(self, sql_arg, column=None, replace=None, sql_filter={}):
@@ -414,102 +419,464 @@ class SqlBuilder(object):
         return select_list, tuple(arg_list)
 
 
+# Statement operations
+SELECT = 'select'
+INSERT = 'insert'
+UPDATE = 'update'
+STAGING = 'staging'
+MERGE = 'merge'
+
+# temp table bulk writes are copied into, dropped when their transaction commits
+STAGING_TABLE = 'mapper_staging'
+# rows per COPY + merge transaction in insert_many/upsert_many
+BULK_CHUNK_SIZE = 5000
+
+
+class CompiledStatement(object):
+    """
+    SQL text plus the plan to pull its arguments out of a dto.
+    columns: the columns the statement returns, in order
+    arg_columns: the dto attribute behind each $n placeholder, in order
+    """
+    def __init__(self, sql, columns, arg_columns, old_columns=()):
+        self.sql = sql
+        self.columns = columns
+        self.arg_columns = arg_columns
+        self.old_columns = old_columns
+
+    def get_args(self, dto, **values):
+        args = []
+        for column in self.arg_columns:
+            if column in values:
+                value = values[column]
+            else:
+                value = dto.get_attr(column)
+            if isinstance(value, Null):
+                value = None
+            args.append(value)
+        return args
+
+    def get_row(self, record):
+        return dict(zip(self.columns, record))
+
+    def get_old_row(self, record):
+        """
+        The old_columns values returned after the row, as they were before the write.
+        """
+        return dict(zip(self.old_columns, tuple(record)[len(self.columns):]))
+
+
+class StatementCompiler(object):
+    """
+    Builds the SQL for a (DtoClass, operation, where_column, present columns)
+    combination once and hands back the cached CompiledStatement afterwards.
+    """
+    def __init__(self):
+        self.statements = {}
+        self.prototypes = {}
+
+    def get_prototype(self, DtoClass):
+        prototype = self.prototypes.get(DtoClass)
+        if prototype is None:
+            prototype = DtoClass()
+            self.prototypes[DtoClass] = prototype
+        return prototype
+
+    @staticmethod
+    def get_signature(dto):
+        """
+        The writable columns that carry a value, None values are left to the database.
+        """
+        return tuple(attr for attr in dto.attributes
+                     if not dto._read_only[attr] and dto.__dict__.get(attr) is not None)
+
+    def get_statement(self, key, build):
+        statement = self.statements.get(key)
+        if statement is None:
+            statement = build()
+            self.statements[key] = statement
+        return statement
+
+    def compile_select(self, DtoClass, table_name, where_column):
+        def build():
+            columns = tuple(self.get_prototype(DtoClass).attributes)
+            sql = "SELECT {0} FROM {1} WHERE {2} IN ($1)".format(', '.join(columns), table_name, where_column)
+            return CompiledStatement(sql, columns, (where_column,))
+
+        return self.get_statement((DtoClass, table_name, SELECT, where_column, None), build)
+
+    def compile_select_many(self, DtoClass, table_name, where_column):
+        def build():
+            columns = tuple(self.get_prototype(DtoClass).attributes)
+            sql = "SELECT {0} FROM {1} WHERE {2} = ANY($1)".format(', '.join(columns), table_name, where_column)
+            return CompiledStatement(sql, columns, (where_column,))
+
+        return self.get_statement((DtoClass, table_name, SELECT, where_column, 'ANY'), build)
+
+    def compile_select_all(self, DtoClass, table_name, columns, order_column='id'):
+        columns = tuple(columns)
+
+        def build():
+            unknown = set(columns) - set(self.get_prototype(DtoClass).attributes)
+            if unknown:
+                raise ValueError("unknown columns {} for {}".format(sorted(unknown), table_name))
+            sql = "SELECT {0} FROM {1} ORDER BY {2}".format(', '.join(columns), table_name, order_column)
+            return CompiledStatement(sql, columns, ())
+
+        return self.get_statement((DtoClass, table_name, SELECT, columns, order_column), build)
+
+    def compile_insert(self, DtoClass, table_name, signature, with_id=False):
+        def build():
+            columns = tuple(self.get_prototype(DtoClass).attributes)
+            insert_columns = signature
+            if with_id and 'id' not in insert_columns:
+                insert_columns = insert_columns + ('id',)
+            values = ', '.join('${}'.format(index) for index in range(1, len(insert_columns) + 1))
+            sql = "INSERT INTO {0} ({1}) VALUES ({2}) ON CONFLICT DO NOTHING RETURNING {3}".format(
+                table_name, ', '.join(insert_columns), values, ', '.join(columns))
+            return CompiledStatement(sql, columns, insert_columns)
+
+        return self.get_statement((DtoClass, table_name, INSERT, with_id, signature), build)
+
+    def compile_staging(self, DtoClass, table_name, staged_columns):
+        def build():
+            sql = "CREATE TEMP TABLE {0} ON COMMIT DROP AS SELECT {1} FROM {2} WITH NO DATA".format(
+                STAGING_TABLE, ', '.join(staged_columns), table_name)
+            return CompiledStatement(sql, staged_columns, staged_columns)
+
+        return self.get_statement((DtoClass, table_name, STAGING, staged_columns), build)
+
+    def compile_merge(self, DtoClass, table_name, staged_columns, conflict_columns=()):
+        """
+        INSERT ... SELECT from the staging table. Without conflict_columns rows that
+        conflict are skipped, with them the other staged columns are updated.
+        Each returned row ends with an extra inserted flag, xmax is 0 only for
+        rows this statement inserted.
+        """
+        def build():
+            columns = tuple(self.get_prototype(DtoClass).attributes)
+            update_columns = [column for column in staged_columns if column not in conflict_columns]
+            if conflict_columns and update_columns:
+                conflict = "ON CONFLICT ({0}) DO UPDATE SET {1}".format(
+                    ', '.join(conflict_columns),
+                    ', '.join('{0} = EXCLUDED.{0}'.format(column) for column in update_columns))
+            else:
+                conflict = "ON CONFLICT DO NOTHING"
+            sql = "INSERT INTO {0} ({1}) SELECT {1} FROM {2} {3} RETURNING {4}, (xmax = 0) AS inserted".format(
+                table_name, ', '.join(staged_columns), STAGING_TABLE, conflict, ', '.join(columns))
+            return CompiledStatement(sql, columns, ())
+
+        return self.get_statement((DtoClass, table_name, MERGE, staged_columns, conflict_columns), build)
+
+    def compile_update(self, DtoClass, table_name, signature, where_column, old_columns=(), key_column='id'):
+        """
+        The rows are locked and their old_columns read in the same statement, the
+        RETURNING list ends with those pre-update values.
+        The locked rows are joined back on key_column, not ctid: a row updated
+        concurrently is locked in its newest version, whose ctid the update's
+        snapshot does not see, while its key still matches.
+        """
+        def build():
+            columns = tuple(self.get_prototype(DtoClass).attributes)
+            update_list = ', '.join('{0} = ${1}'.format(column, index)
+                                    for index, column in enumerate(signature, 1))
+            old_list = ''.join(', {0} AS old_{0}'.format(column) for column in old_columns)
+            sql = "UPDATE {0} AS target SET {1} FROM (SELECT {2} AS old_key{3} FROM {0} WHERE {4} = ${5} " \
+                  "FOR UPDATE) old WHERE target.{2} = old.old_key RETURNING {6}{7}".format(
+                      table_name, update_list, key_column, old_list, where_column, len(signature) + 1,
+                      ', '.join('target.{}'.format(column) for column in columns),
+                      ''.join(', old.old_{}'.format(column) for column in old_columns))
+            return CompiledStatement(sql, columns, signature + (where_column,), old_columns)
+
+        return self.get_statement((DtoClass, table_name, UPDATE, where_column, signature, old_columns,
+                                   key_column), build)
+
+    def compile_locked_rows(self, DtoClass, table_name, conflict_columns, old_columns):
+        """
+        Current old_columns of the rows an upsert from the staging table will update.
+        """
+        def build():
+            sql = "SELECT {0} FROM {1} AS target JOIN {2} USING ({3}) FOR UPDATE OF target".format(
+                ', '.join('target.{}'.format(column) for column in old_columns), table_name, STAGING_TABLE,
+                ', '.join(conflict_columns))
+            return CompiledStatement(sql, old_columns, ())
+
+        return self.get_statement((DtoClass, table_name, STAGING, conflict_columns, old_columns), build)
+
+
+statement_compiler = StatementCompiler()
+
+
+# bumped on every write to a table, a select that raced a write does not cache its row
+cache_generations = {}
+# concurrent select() misses on the same cache key share one query
+select_flight = SingleFlight()
+# refresh-ahead selects running in the background, referenced until they finish
+refresh_tasks = set()
+
+
+def finish_refresh(task):
+    refresh_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        log.warning('Refresh ahead select failed: {!r}'.format(task.exception()))
+
+
 class Mapper(object):
-    def __init__(self, db, DtoClass, table_name='', table_name_id_seq=''):
+    """
+    cache_columns: columns select() caches rows under; writes invalidate every
+                   cached key of the rows they touch
+    unique_columns: subset of cache_columns that identify one row, their keys are
+                    refreshed with the written row instead of just dropped
+    refresh_ahead: a cache hit with less than this many seconds left is served
+                   as is and re-read in the background (stale-while-revalidate)
+    """
+    def __init__(self, db, DtoClass, table_name='', table_name_id_seq='',
+                 cache_columns=('id',), unique_columns=('id',), refresh_ahead=0):
         self.DtoClass = DtoClass
         self.db = db
         self.table_name = table_name
         self.table_name_id_seq = table_name_id_seq
+        self.cache_columns = cache_columns
+        self.unique_columns = unique_columns
+        self.refresh_ahead = refresh_ahead
 
     async def insert(self, dto, dto_id=None):
         dto = await self.convert_to_db(dto)
-        sql_builder = self.get_sql_builder(dto)
-
+        statement = statement_compiler.compile_insert(self.DtoClass, self.table_name,
+                                                      statement_compiler.get_signature(dto), with_id=bool(dto_id))
         if dto_id:
-            sql_builder.add_insert("id", '%s', (dto_id,))
-
-        column_list, value_list, insert_arg_list = sql_builder.get_insert()
-        select_list, select_arg_list = sql_builder.get_select()
-
-        sql = "INSERT INTO {0} ({1}) VALUES %b ON CONFLICT DO NOTHING RETURNING {2}".format(self.table_name, column_list, select_list)
-
-        if dto_id:
-            sql_args = (BulkList(*insert_arg_list, replace='(' + value_list + ')', sql_filter={"id": dto_id}),) + select_arg_list
+            sql_args = statement.get_args(dto, id=dto_id)
         else:
-            sql_args = (BulkList(*insert_arg_list, replace='(' + value_list + ')', sql_filter={}),) + select_arg_list
-
-        sql_args = self.get_cache_args(sql_args)
-        new_args = []
-        for args in sql_args:
-            new_args += list(args)
+            sql_args = statement.get_args(dto)
 
-        value_str = await self.get_insert_value_str(sql_args)
-        sql = sql.replace('%b', value_str)
-
-        db_return = await self.db.fetch_one_row(sql, args=new_args)
+        self.bump_cache_generation()
+        db_return = await self.db.fetch_one_row(statement.sql, args=sql_args)
 
         print("insert", db_return)
         if not db_return:
             return
+        db_return = statement.get_row(db_return)
+        self.refresh_cache(db_return)
         dto = self.get_dto(**db_return)
         return dto
 
-    async def get_insert_value_str(self, sql_args):
-        value_str = ""
-        para_count = 1
-        for args in sql_args:
-            args_str = "("
-            vals = []
-            for val in args:
-                vals.append("${}".format(para_count))
-                para_count += 1
-            args_str += ",".join(vals)
-            args_str += ")"
-
-            value_str += args_str
-
-        return value_str
-
     async def select(self, dto, where_column):
         dto = await self.convert_to_db(dto)
-        sql_builder = self.get_sql_builder(dto)
-        select_list, select_arg_list = sql_builder.get_select()
-        sql = """SELECT {0} FROM {1} WHERE {2} IN ($1)""".format(select_list, self.table_name, where_column)
-        sql_args = select_arg_list + (BulkVar(dto.get_attr(where_column), column=where_column),)
-        sql_args = self.get_cache_args(sql_args)
-        print(sql_args)
-        db_return = sql_cached.get_cache("business {where} = {value}".format(where=where_column,
-                                                                             value=sql_args))
-
-        print(sql)
+        statement = statement_compiler.compile_select(self.DtoClass, self.table_name, where_column)
+        sql_args = tuple(statement.get_args(dto))
+        cache_key = self.get_cache_key(where_column, sql_args[0])
+        cacheable = where_column in self.cache_columns
+        db_return = sql_cached.get_cache(cache_key) if cacheable else None
+
         if not db_return:
             print("no cached")
-            db_return = await self.db.fetch_one_row(sql, args=sql_args)
+            db_return = await select_flight.do(cache_key, self.fetch_row, statement, sql_args, cache_key, cacheable)
             if not db_return:
                 return
-            db_return = {k.strip(): v for k, v in zip(select_list.split(','), db_return)}
-            if db_return:
-                sql_cached.set_cache(cache_id="business {where} = {value}".format(where=where_column,
-                                                                                  value=sql_args),
-                                     value=db_return)
+        elif self.refresh_ahead and not select_flight.is_running(cache_key) and \
+                sql_cached.get_remaining_time(cache_key) < self.refresh_ahead:
+            task = asyncio.ensure_future(select_flight.do(cache_key, self.fetch_row, statement, sql_args,
+                                                          cache_key, cacheable))
+            refresh_tasks.add(task)
+            task.add_done_callback(finish_refresh)
         dto = self.get_dto(**db_return)
         return dto
 
+    async def fetch_row(self, statement, sql_args, cache_key, cacheable):
+        generation = self.get_cache_generation()
+        db_return = await self.db.fetch_one_row(statement.sql, args=sql_args)
+        if not db_return:
+            return
+        db_return = statement.get_row(db_return)
+        if cacheable and generation == self.get_cache_generation():
+            sql_cached.set_cache(cache_id=cache_key, value=db_return)
+        return db_return
+
+    def iterate_all(self, columns, order_column='id'):
+        """
+        columns, rows = mapper.iterate_all(EXPORT_COLUMNS)
+        async for record in rows:
+            ...
+
+        Every row of the table as asyncpg records, streamed from a server side
+        cursor and never cached. Only the given columns are read, so exports list
+        theirs explicitly and credentials never leave the database. The column
+        names come first, for export headers.
+        """
+        statement = statement_compiler.compile_select_all(self.DtoClass, self.table_name, columns, order_column)
+        return statement.columns, self.db.iterate_rows(statement.sql)
+
+    async def select_many(self, dtos_or_values, where_column='id'):
+        """
+        dtos = await mapper.select_many([1, 2, 3])
+        dtos = await mapper.select_many(dtos, 'username')
+
+        Batched select(): cached keys are served from sql_cached, all the misses
+        are read with one WHERE where_column = ANY($1) query and cached. Returns a
+        list in input order with None for the keys that have no row.
+        """
+        values = []
+        for item in dtos_or_values:
+            if not isinstance(item, Dto):
+                # raw values go through the column's DtoType like select() arguments
+                item = self.get_dto(**{where_column: item})
+            item = (await self.convert_to_db(item)).get_attr(where_column)
+            values.append(None if isinstance(item, Null) else item)
+
+        cacheable = where_column in self.cache_columns
+        rows = {}
+        misses = []
+        for value in values:
+            if value is None or value in rows:
+                continue
+            db_return = sql_cached.get_cache(self.get_cache_key(where_column, value)) if cacheable else None
+            rows[value] = db_return
+            if not db_return:
+                misses.append(value)
+
+        if misses:
+            statement = statement_compiler.compile_select_many(self.DtoClass, self.table_name, where_column)
+            generation = self.get_cache_generation()
+            db_return = await self.db.fetch_all_rows(statement.sql, args=(misses,))
+            cache_fresh = cacheable and generation == self.get_cache_generation()
+            for record in db_return or []:
+                row = statement.get_row(record)
+                value = row[where_column]
+                # like select(), a non unique column resolves to the first row found
+                if rows.get(value):
+                    continue
+                rows[value] = row
+                if cache_fresh:
+                    sql_cached.set_cache(cache_id=self.get_cache_key(where_column, value), value=row)
+
+        return [self.get_dto(**rows[value]) if rows.get(value) else None for value in values]
+
+    async def insert_many(self, dtos, chunk_size=BULK_CHUNK_SIZE):
+        """
+        counts = await mapper.insert_many(dtos)
+
+        Bulk insert(): dtos, a list or an async iterator, are copied into a temp
+        staging table and merged with one INSERT ... ON CONFLICT DO NOTHING per
+        chunk. Returns {'inserted': n, 'updated': 0, 'skipped': n}.
+        """
+        return await self.write_many(dtos, (), chunk_size)
+
+    async def upsert_many(self, dtos, conflict_columns=('id',), chunk_size=BULK_CHUNK_SIZE):
+        """
+        counts = await mapper.upsert_many(dtos, conflict_columns=('username',))
+
+        Like insert_many, rows that conflict on conflict_columns (which need a
+        unique index) are updated with the staged values instead of skipped.
+        A key may appear only once per chunk, postgres refuses to update the
+        same row twice in one statement.
+        """
+        return await self.write_many(dtos, tuple(conflict_columns), chunk_size)
+
+    async def write_many(self, dtos, conflict_columns, chunk_size):
+        counts = {'inserted': 0, 'updated': 0, 'skipped': 0}
+        # dtos with the same set of filled in columns are staged together,
+        # the columns left out take their database defaults
+        pending = {}
+
+        async def add(dto):
+            dto = await self.convert_to_db(dto)
+            staged_columns = statement_compiler.get_signature(dto)
+            staged_columns += tuple(column for column in conflict_columns if column not in staged_columns)
+            chunk = pending.setdefault(staged_columns, [])
+            chunk.append(dto)
+            if len(chunk) >= chunk_size:
+                del pending[staged_columns]
+                await self.write_chunk(staged_columns, chunk, conflict_columns, counts)
+
+        if hasattr(dtos, '__aiter__'):
+            async for dto in dtos:
+                await add(dto)
+        else:
+            for dto in dtos:
+                await add(dto)
+        for staged_columns, chunk in pending.items():
+            await self.write_chunk(staged_columns, chunk, conflict_columns, counts)
+        return counts
+
+    async def write_chunk(self, staged_columns, dtos, conflict_columns, counts):
+        staging = statement_compiler.compile_staging(self.DtoClass, self.table_name, staged_columns)
+        merge = statement_compiler.compile_merge(self.DtoClass, self.table_name, staged_columns, conflict_columns)
+        records = [tuple(staging.get_args(dto)) for dto in dtos]
+
+        old_rows = []
+        self.bump_cache_generation()
+        async with self.db.transaction() as connect:
+            await connect.execute(staging.sql)
+            await connect.copy_records_to_table(STAGING_TABLE, records=records, columns=staged_columns)
+            if conflict_columns:
+                # updated rows may change cached columns, their old keys must go too
+                locked = statement_compiler.compile_locked_rows(self.DtoClass, self.table_name, conflict_columns,
+                                                                self.cache_columns)
+                old_rows = [locked.get_row(record) for record in await connect.fetch(locked.sql)]
+            db_return = await connect.fetch(merge.sql)
+
+        self.invalidate_cache(old_rows)
+        for record in db_return:
+            if record['inserted']:
+                counts['inserted'] += 1
+            else:
+                counts['updated'] += 1
+            self.refresh_cache(merge.get_row(record))
+        counts['skipped'] += len(records) - len(db_return)
+
     async def update(self, dto, where_column='id'):
         dto = await self.convert_to_db(dto)
-        sql_builder = self.get_sql_builder(dto)
-        update_list, update_arg_list = sql_builder.get_update()
-        select_list, select_arg_list = sql_builder.get_select()
+        statement = statement_compiler.compile_update(self.DtoClass, self.table_name,
+                                                      statement_compiler.get_signature(dto), where_column,
+                                                      old_columns=self.cache_columns,
+                                                      key_column=self.unique_columns[0])
+        sql_args = statement.get_args(dto)
+        print("update", statement.sql, sql_args)
+        self.bump_cache_generation()
+        db_return = await self.db.fetch_one_row(statement.sql, args=sql_args)
 
-        sql = 'UPDATE {0} SET {1} WHERE {2} = %s RETURNING {3}'.format(self.table_name, update_list, where_column, select_list)
-        sql_args = update_arg_list + (dto.get_attr(where_column),) + select_arg_list
-        sql_args = self.get_cache_args(sql_args)
-        print("update", sql, sql_args)
-        db_return = self.static_db.fetch_one_row(sql, args=sql_args, dict_cursor=True)
-
-        dto = self.get_dto(**db_return.query_data)
+        if not db_return:
+            sql_cached.delete_cache(self.get_cache_key(where_column, sql_args[-1]))
+            return
+        stale_row = statement.get_old_row(db_return)
+        db_return = statement.get_row(db_return)
+        self.refresh_cache(db_return, stale_rows=[stale_row])
+        dto = self.get_dto(**db_return)
         return dto
 
+    def get_cache_key(self, where_column, value):
+        return "{table} {where} = {value!r}".format(table=self.table_name, where=where_column, value=value)
+
+    def get_cache_generation(self):
+        return cache_generations.get(self.table_name, 0)
+
+    def bump_cache_generation(self):
+        cache_generations[self.table_name] = self.get_cache_generation() + 1
+
+    def invalidate_cache(self, rows):
+        for row in rows:
+            for column in self.cache_columns:
+                sql_cached.delete_cache(self.get_cache_key(column, row.get(column)))
+
+    def refresh_cache(self, row, stale_rows=()):
+        """
+        Write-through after an insert/update: drop every key cached for the old
+        and new versions of the row, then cache the new row under its unique columns.
+        The generation is bumped again now that the write is done, a select that
+        read the row before the commit does not cache it over this refresh.
+        """
+        self.bump_cache_generation()
+        stale_rows = list(stale_rows) + [row]
+        for column in self.cache_columns:
+            cached = sql_cached.get_cache(self.get_cache_key(column, row.get(column)))
+            if cached:
+                stale_rows.append(cached)
+        self.invalidate_cache(stale_rows)
+
+        for column in self.unique_columns:
+            if row.get(column) is not None:
+                sql_cached.set_cache(cache_id=self.get_cache_key(column, row[column]), value=dict(row))
+
     def get_properties(self):
         dto = self.get_dto().properties()
         return dto
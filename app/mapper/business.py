@@ -1,6 +1,10 @@
 from mapper.base import Mapper, Dto, DtoInteger, DtoText, DtoBoolean, DtoTimestamp, DtoObject, BulkVar, BulkList
 from lib.hash_password import hash_password
 
+# columns of /business/export, password and hash_recovery are credentials and stay out
+EXPORT_COLUMNS = ('id', 'username', 'email', 'phone', 'full_address', 'business_role',
+                  'business_owner_id', 'created')
+
 class DtoBusiness(Dto):
     def __init__(self, **kwargs):
         Dto.__init__(self)
@@ -19,7 +23,8 @@ class DtoBusiness(Dto):
 
 class MapperBusiness(Mapper):
     def __init__(self, db, static_db):
-        Mapper.__init__(self, db, DtoBusiness, 'option.business')
+        Mapper.__init__(self, db, DtoBusiness, 'option.business',
+                        cache_columns=('id', 'username'), unique_columns=('id', 'username'), refresh_ahead=60)
         self.static_db=static_db
 
     async def select_business(self, dto, where_column='id'):
@@ -1,6 +1,28 @@
 from mapper.base import Mapper, Dto, DtoInteger, DtoText, DtoBoolean, DtoTimestamp, DtoObject, BulkVar, BulkList
+from datetime import datetime, timedelta
+from lib.cache_data import CacheData
+import asyncio
+import logging
+import secrets
 import string
-import random
+
+log = logging.getLogger(__name__)
+
+TOKEN_LENGTH = 32
+TOKEN_REFRESH_INTERVAL = 30
+# every TOKEN_FULL_RELOAD_EVERY refreshes the index is rebuilt to pick up deleted sessions
+TOKEN_FULL_RELOAD_EVERY = 20
+# unknown tokens remembered so repeated guesses do not each cost a query
+TOKEN_MAX_MISSES = 10000
+# columns of /token/export, the id is the bearer token itself and stays out
+EXPORT_COLUMNS = ('business_id', 'modified', 'lifetime', 'data')
+
+
+def is_session_expired(session):
+    modified, lifetime = session['modified'], session['lifetime']
+    if modified is None or lifetime is None:
+        return True
+    return modified + timedelta(seconds=lifetime) <= datetime.now()
 
 
 class DtoSession(Dto):
@@ -16,13 +38,14 @@ class DtoSession(Dto):
 
 class MapperSession(Mapper):
     def __init__(self, db, static_db, mapper_business):
-        Mapper.__init__(self, db, DtoSession, 'option.session')
+        Mapper.__init__(self, db, DtoSession, 'option.session',
+                        cache_columns=('id', 'business_id'), unique_columns=('id',))
         self.static_db = static_db
         self.mapper_business = mapper_business
 
     async def get_next_seq_id(self):
         ascii_set = string.ascii_uppercase + string.ascii_lowercase
-        token = ''.join(random.sample(ascii_set, 32))
+        token = ''.join(secrets.choice(ascii_set) for _ in range(TOKEN_LENGTH))
         return token
 
     async def select_token(self, dto, where_column='id'):
@@ -34,3 +57,142 @@ class MapperSession(Mapper):
         dto = await self.insert(dto, dto_id=id_value)
         return dto
 
+    async def insert_tokens(self, dtos):
+        """
+        Bulk insert_token(), every dto gets a new token id. Returns the insert_many counts.
+        """
+        for dto in dtos:
+            dto.update(id=await self.get_next_seq_id())
+        return await self.insert_many(dtos)
+
+    async def renew_token(self, dto):
+        """
+        Gives an expired session a new token id and starts its lifetime again.
+        """
+        old_row = dict(dto)
+        columns = ', '.join(dto.attributes)
+        sql = "UPDATE {0} SET id = $1, modified = $2 WHERE id = $3 RETURNING {1}".format(self.table_name, columns)
+        self.bump_cache_generation()
+        db_return = await self.db.fetch_one_row(sql, [await self.get_next_seq_id(), datetime.now(), dto.id])
+        if not db_return:
+            return
+        row = dict(zip(dto.attributes, db_return))
+        self.refresh_cache(row, stale_rows=[old_row])
+        return self.get_dto(**row)
+
+    async def select_live_token(self, token):
+        sql = "SELECT id, modified, lifetime, business_id FROM {0} " \
+              "WHERE id = $1 AND modified + lifetime * interval '1 second' > now()".format(self.table_name)
+        return await self.db.fetch_one_row(sql, [token])
+
+    async def select_live_tokens(self, since=None):
+        """
+        Sessions that have not expired yet, only those modified at or after since when given.
+        """
+        sql = "SELECT id, modified, lifetime, business_id FROM {0} " \
+              "WHERE modified + lifetime * interval '1 second' > now()".format(self.table_name)
+        if since is None:
+            return await self.db.fetch_all_rows(sql)
+        return await self.db.fetch_all_rows(sql + " AND modified >= $1", [since])
+
+
+class SessionTokenIndex(object):
+    """
+    In-memory index of live session tokens: id -> (business_id, expiry), expiry
+    being modified + lifetime. Validating a token is a dict lookup.
+
+    warm() loads every live session, start() keeps the index fresh in the
+    background by reading sessions modified since the last load, with a full
+    reload every full_reload_every rounds. Tokens issued by this process are
+    add()ed straight away.
+    """
+
+    def __init__(self, mapper_session, refresh_interval=TOKEN_REFRESH_INTERVAL,
+                 full_reload_every=TOKEN_FULL_RELOAD_EVERY):
+        self.mapper_session = mapper_session
+        self.refresh_interval = refresh_interval
+        self.full_reload_every = full_reload_every
+        self.tokens = {}
+        self.last_modified = None
+        self.refreshes = 0
+        self.task = None
+        self.misses = CacheData(cache_time=refresh_interval, max_cache_number=TOKEN_MAX_MISSES, frozen=True)
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def add(self, session):
+        token, modified, lifetime = session['id'], session['modified'], session['lifetime']
+        if token is None or modified is None or lifetime is None:
+            return
+        self.tokens[token.strip()] = (session['business_id'], modified + timedelta(seconds=lifetime))
+        if self.last_modified is None or modified > self.last_modified:
+            self.last_modified = modified
+
+    def discard(self, token):
+        self.tokens.pop(token, None)
+
+    async def lookup(self, token):
+        """
+        get_business_id, falling back to the database for well-formed tokens the
+        index does not know yet, e.g. issued by another replica since the last
+        refresh. Unknown tokens are remembered for one refresh interval.
+        """
+        business_id = self.get_business_id(token)
+        if business_id is not None or len(token) != TOKEN_LENGTH or not token.isalpha():
+            return business_id
+        if self.misses.get_cache(token):
+            return None
+        row = await self.mapper_session.select_live_token(token)
+        if not row:
+            self.misses.set_cache(token, True)
+            return None
+        self.add(row)
+        return self.get_business_id(token)
+
+    def get_business_id(self, token):
+        entry = self.tokens.get(token)
+        if entry is None:
+            return None
+        business_id, expiry = entry
+        if expiry <= datetime.now():
+            del self.tokens[token]
+            return None
+        return business_id
+
+    async def warm(self):
+        rows = await self.mapper_session.select_live_tokens()
+        self.tokens = {}
+        self.last_modified = None
+        for row in rows:
+            self.add(row)
+        log.info('Session token index loaded {} tokens'.format(len(self.tokens)))
+
+    async def refresh(self):
+        self.refreshes += 1
+        if self.last_modified is None or self.refreshes % self.full_reload_every == 0:
+            await self.warm()
+            return
+        for row in await self.mapper_session.select_live_tokens(since=self.last_modified):
+            self.add(row)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.refresh()
+            except Exception as error:
+                log.warning('Session token index refresh failed: {}'.format(error))
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
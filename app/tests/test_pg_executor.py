@@ -0,0 +1,83 @@
+import asyncio
+import os
+import sys
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncpg
+
+from lib.pg_executor import PGExecutor
+
+
+class FakePreparedStatement(object):
+    """
+    Carries asyncpg's guard: a statement prepared before a release refuses to run.
+    """
+    def __init__(self, connect, sql):
+        self.connect = connect
+        self.sql = sql
+        self.release_ctr = connect.pool_release_ctr
+
+    async def fetch(self, *args):
+        if self.release_ctr != self.connect.pool_release_ctr:
+            raise asyncpg.InterfaceError('cannot call PreparedStatement.fetch(): the underlying connection '
+                                         'has been released back to the pool')
+        return await self.connect.fetch(self.sql, *args)
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.statement_texts = OrderedDict()
+        self.pool_release_ctr = 0
+        self.queries = []
+
+    def get_idle_time(self):
+        return 0
+
+    def mark_released(self):
+        pass
+
+    async def prepare(self, sql):
+        return FakePreparedStatement(self, sql)
+
+    async def fetch(self, sql, *args):
+        self.queries.append((sql, args))
+        return [{'id': args[0]}]
+
+    async def execute(self, sql, *args):
+        self.queries.append((sql, args))
+        return 'UPDATE 1'
+
+
+class FakePool(object):
+    def __init__(self, connect):
+        self.connect = connect
+
+    async def acquire(self, timeout=None):
+        return self.connect
+
+    async def release(self, connect):
+        # asyncpg's Connection._on_release()
+        connect.pool_release_ctr += 1
+
+
+def test_pooled_connection_runs_the_same_query_twice():
+    connect = FakeConnection()
+    db = PGExecutor('user', 'password', 'localhost', use_pool=True)
+    db.pool = FakePool(connect)
+    sql = 'SELECT id FROM option.business WHERE id = $1'
+
+    async def run():
+        first = await db.fetch_one_row(sql, args=(1,))
+        second = await db.fetch_one_row(sql, args=(2,))
+        status = await db.modify_rows('UPDATE option.business SET email = $1 WHERE id = $2', args=('a', 2))
+        return first, second, status
+
+    first, second, status = asyncio.run(run())
+    assert first == {'id': 1}
+    assert second == {'id': 2}
+    assert status == 'UPDATE 1'
+    assert connect.pool_release_ctr == 3
+    stats = db.get_statement_stats()
+    assert (stats['hits'], stats['misses']) == (1, 2)
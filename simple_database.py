@@ -1,5 +1,49 @@
+import io
+import itertools
+import json
+from contextlib import contextmanager
+import psycopg2
 from pg_accessor import PostgresAccessor
 
+# bulk_insert modes
+VALUES_MODE = 'values'
+COPY_MODE = 'copy'
+STAGING_TABLE = 'bulk_insert_staging'
+# keys per query in select_many/delete_many
+KEY_BLOCK = 1000
+
+
+def to_copy_text(value):
+    """
+    Postgres text input of a value, the form psycopg2 would adapt it to:
+    bytes as bytea hex, dicts as json and lists as array literals.
+    """
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return '\\x' + bytes(value).hex()
+    if isinstance(value, dict):
+        return json.dumps(value)
+    if isinstance(value, (list, tuple)):
+        return '{' + ','.join(to_array_element(item) for item in value) + '}'
+    return str(value)
+
+
+def to_array_element(value):
+    if value is None:
+        return 'NULL'
+    if isinstance(value, (list, tuple)):
+        return to_copy_text(value)
+    return '"' + to_copy_text(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def to_copy_field(value):
+    """
+    COPY csv field: None is an empty unquoted field (NULL), everything else is
+    quoted so an empty string stays an empty string.
+    """
+    if value is None:
+        return ''
+    return '"' + to_copy_text(value).replace('"', '""') + '"'
+
 
 class PostgresAccessorBulk(PostgresAccessor):
     _table_name = ''
@@ -31,6 +75,61 @@ class PostgresAccessorBulk(PostgresAccessor):
             return res
         return []
 
+    def select_many(self, data_list, where_columns=["guid"], block=KEY_BLOCK):
+        """
+        select_all for many keys at once, one query per block keys.
+        Returns {(where column values): [rows]} keyed by the values as passed in,
+        with [] for keys without rows. Postgres casts the keys to the column type,
+        so rows are matched back by text form: '5' finds the row with id 5.
+        """
+        result = {}
+        for keys in self.generate_key_blocks(data_list, where_columns, block):
+            args, column_statements = self.generate_many_condition_statment_and_args(keys, where_columns)
+            sql = """
+            SELECT * FROM {table}
+            WHERE {column_statements}
+            """.format(table=self._table_name,
+                       column_statements=column_statements)
+            requested = {}
+            for key in keys:
+                result[key] = []
+                requested.setdefault(self.get_key_text(key), []).append(key)
+            for row in self._execute_query(sql, args) or []:
+                row_key = tuple(row[col] for col in where_columns)
+                for key in requested.get(self.get_key_text(row_key), [row_key]):
+                    result.setdefault(key, []).append(row)
+        return result
+
+    def delete_many(self, data_list, where_columns=["guid"], block=KEY_BLOCK):
+        for keys in self.generate_key_blocks(data_list, where_columns, block):
+            args, column_statements = self.generate_many_condition_statment_and_args(keys, where_columns)
+            sql = """
+            DELETE FROM {table}
+            WHERE {column_statements}
+            """.format(table=self._table_name,
+                       column_statements=column_statements)
+            self._execute_dml(sql, args, raise_exception=True)
+
+    @staticmethod
+    def generate_key_blocks(data_list, where_columns, block):
+        """
+        Unique key tuples of data_list, in order, in lists of at most block keys.
+        """
+        keys = list(dict.fromkeys(tuple(data[col] for col in where_columns) for data in data_list))
+        for start in range(0, len(keys), block):
+            yield keys[start:start + block]
+
+    @staticmethod
+    def get_key_text(key):
+        return tuple(None if value is None else str(value) for value in key)
+
+    @staticmethod
+    def generate_many_condition_statment_and_args(keys, where_columns):
+        # IN with literals instead of = ANY(array) lets postgres cast each value to the column type
+        if len(where_columns) == 1:
+            return [tuple(key[0] for key in keys)], " {} IN %s ".format(where_columns[0])
+        return [tuple(keys)], " ({}) IN %s ".format(",".join(where_columns))
+
     @staticmethod
     def generate_condition_statment_and_args(data, where_columns):
         column_statements = [" {} = %s ".format(col) for col in where_columns]
@@ -97,7 +196,18 @@ class PostgresAccessorBulk(PostgresAccessor):
         except Exception as e:
             self._logger.error('Adding portfolio to portfolio manager encountered exception: ' + str(e))
 
-    def bulk_insert(self, data, block=3000):
+    def bulk_insert(self, data, block=3000, mode=VALUES_MODE, conflict_columns=None, update_columns=None):
+        """
+        mode=VALUES_MODE: one multi-row INSERT per block of rows.
+        mode=COPY_MODE: rows (dicts, a list or any iterable) are streamed with
+        COPY ... FROM STDIN on one pooled connection, flushing every block rows,
+        and committed once. With conflict_columns they are copied into a staging
+        table and merged with INSERT ... ON CONFLICT (conflict_columns) DO UPDATE
+        of update_columns (default: all other columns, [] means DO NOTHING).
+        """
+        if mode == COPY_MODE:
+            return self.bulk_copy(data, block, conflict_columns, update_columns)
+
         if not isinstance(data, list):
             raise ValueError("bulks data must be list type")
 
@@ -132,5 +242,81 @@ class PostgresAccessorBulk(PostgresAccessor):
 
         return insert_sql, args_values
 
+    def bulk_copy(self, data, block=3000, conflict_columns=None, update_columns=None):
+        rows = iter(data)
+        first_row = next(rows, None)
+        if first_row is None:
+            return 0
+        insert_columns = [col for col in self._columns if col in first_row.keys()]
+        columns_statement = ",".join(insert_columns)
+        target = STAGING_TABLE if conflict_columns else self._table_name
+        copy_sql = "COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv)".format(table=target,
+                                                                                  columns=columns_statement)
+
+        with self.copy_connection() as conn:
+            with conn.cursor() as cur:
+                if conflict_columns:
+                    cur.execute("CREATE TEMP TABLE {staging} ON COMMIT DROP AS SELECT {columns} FROM {table} "
+                                "WITH NO DATA".format(staging=STAGING_TABLE, columns=columns_statement,
+                                                      table=self._table_name))
 
+                row_count = 0
+                buffer = io.StringIO()
+                buffered = 0
+                for dictionay_row in itertools.chain([first_row], rows):
+                    buffer.write(",".join(to_copy_field(dictionay_row.get(col)) for col in insert_columns))
+                    buffer.write("\n")
+                    buffered += 1
+                    if buffered >= block:
+                        self.flush_copy_buffer(cur, copy_sql, buffer)
+                        row_count += buffered
+                        buffered = 0
+                if buffered:
+                    self.flush_copy_buffer(cur, copy_sql, buffer)
+                    row_count += buffered
+
+                if conflict_columns:
+                    cur.execute(self.generate_merge_sql(insert_columns, conflict_columns, update_columns))
+                    row_count = cur.rowcount
+            conn.commit()
+        return row_count
+
+    @contextmanager
+    def copy_connection(self):
+        """
+        COPY needs a raw psycopg2 connection: the pooled one when the accessor is
+        simple_mapper.PostgresAccessor, otherwise a connection of its own.
+        """
+        pool = getattr(self, '_pool', None)
+        if pool is not None:
+            with pool.connection() as conn:
+                yield conn
+            return
+        conn = psycopg2.connect(self._connection_string)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def flush_copy_buffer(cursor, copy_sql, buffer):
+        buffer.seek(0)
+        cursor.copy_expert(copy_sql, buffer)
+        buffer.seek(0)
+        buffer.truncate()
 
+    def generate_merge_sql(self, insert_columns, conflict_columns, update_columns=None):
+        if update_columns is None:
+            update_columns = [col for col in insert_columns if col not in conflict_columns]
+        columns_statement = ",".join(insert_columns)
+        if update_columns:
+            conflict_statement = "DO UPDATE SET " + ",".join("{col} = EXCLUDED.{col}".format(col=col)
+                                                             for col in update_columns)
+        else:
+            conflict_statement = "DO NOTHING"
+        return """
+        INSERT INTO {table} ({columns})
+        SELECT {columns} FROM {staging}
+        ON CONFLICT ({conflict_columns}) {conflict_statement}
+        """.format(table=self._table_name, columns=columns_statement, staging=STAGING_TABLE,
+                   conflict_columns=",".join(conflict_columns), conflict_statement=conflict_statement)
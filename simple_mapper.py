@@ -1,6 +1,11 @@
-from decimal import Decimal
+from contextlib import contextmanager
 import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
 import logging
+import threading
+import time
+import traceback
 from querybuilder.query import Query
 from django.db.models import Q
 from django.db.models import QuerySet
@@ -103,6 +108,223 @@ class SbtQuery (Query):
     else :
       return Query.get_args(self)
 
+# numeric columns come back as float, Decimal does not convert to JSON
+DEC2FLOAT = psycopg2.extensions.new_type(
+  psycopg2.extensions.DECIMAL.values,
+  'DEC2FLOAT',
+  lambda value, curs: float(value) if value is not None else None)
+
+# _execute_query result formats
+DICT_RESULT = 'dict'
+TUPLE_RESULT = 'tuple'
+COLUMNAR_RESULT = 'columnar'
+DATAFRAME_RESULT = 'dataframe'
+
+POOL_MIN_SIZE = 1
+POOL_MAX_SIZE = 10
+# seconds to wait for a free connection before giving up
+POOL_CHECKOUT_TIMEOUT = 30
+# idle connections older than this are checked with SELECT 1 before reuse
+POOL_VALIDATE_AFTER = 30
+# a connection checked out for longer than this is logged as leaked
+POOL_LEAK_TIMEOUT = 300
+
+
+class PoolTimeoutError(Exception):
+  pass
+
+
+"""
+  Thread-safe psycopg2 connection pool, one per connection string
+"""
+class PostgresConnectionPool:
+  _pools = {}
+  _pools_lock = threading.Lock()
+
+  """
+    Initializes the pool, no connection is opened before the first checkout
+  """
+  def __init__(self, connection_string, min_size=POOL_MIN_SIZE,
+               max_size=POOL_MAX_SIZE, checkout_timeout=POOL_CHECKOUT_TIMEOUT,
+               validate_after=POOL_VALIDATE_AFTER,
+               leak_timeout=POOL_LEAK_TIMEOUT):
+    self._connection_string = connection_string
+    self._min_size = min_size
+    self._max_size = max_size
+    self._checkout_timeout = checkout_timeout
+    self._validate_after = validate_after
+    self._leak_timeout = leak_timeout
+    self._lock = threading.Condition()
+    # (connection, time it was returned), most recently used last
+    self._idle = []
+    # id(connection) -> (checkout time, stack of the caller)
+    self._checked_out = {}
+    self._size = 0
+    self._warmed = False
+
+  """
+    Returns the shared pool for connection_string, creating it on first use
+  """
+  @classmethod
+  def get_pool(cls, connection_string, **kwargs):
+    with cls._pools_lock:
+      pool = cls._pools.get(connection_string)
+      if pool is None:
+        pool = cls(connection_string, **kwargs)
+        cls._pools[connection_string] = pool
+      return pool
+
+  """
+    Closes every pool, e.g. at process exit or after a fork
+  """
+  @classmethod
+  def close_all_pools(cls):
+    with cls._pools_lock:
+      pools = list(cls._pools.values())
+      cls._pools.clear()
+    for pool in pools:
+      pool.close()
+
+  """
+    with pool.connection() as conn:
+      ...
+    Checks a connection out and always returns it, a connection that broke
+    while in use is discarded instead
+  """
+  @contextmanager
+  def connection(self):
+    conn = self.getconn()
+    try:
+      yield conn
+    finally:
+      self.putconn(conn)
+
+  def getconn(self):
+    self._warm()
+    deadline = time.monotonic() + self._checkout_timeout
+    while True:
+      conn, returned = None, None
+      with self._lock:
+        while not self._idle and self._size >= self._max_size:
+          remaining = deadline - time.monotonic()
+          if remaining <= 0:
+            self.check_leaks()
+            raise PoolTimeoutError('No connection free after ' +
+                                   str(self._checkout_timeout) + ' seconds')
+          self._lock.wait(remaining)
+        if self._idle:
+          conn, returned = self._idle.pop()
+        else:
+          self._size += 1
+
+      if conn is None:
+        try:
+          conn = psycopg2.connect(self._connection_string)
+        except Exception:
+          with self._lock:
+            self._size -= 1
+            self._lock.notify()
+          raise
+      elif not self._is_valid(conn, returned):
+        self._discard(conn)
+        continue
+
+      with self._lock:
+        self._checked_out[id(conn)] = (time.monotonic(),
+                                       traceback.extract_stack(limit=8))
+      return conn
+
+  def putconn(self, conn):
+    with self._lock:
+      self._checked_out.pop(id(conn), None)
+    try:
+      if not conn.closed:
+        status = conn.get_transaction_status()
+        if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+          conn.rollback()
+        conn.autocommit = False
+    except Exception as e:
+      logging.info('Discarding pooled connection: ' + str(e))
+      self._discard(conn)
+      return
+    if conn.closed:
+      self._discard(conn)
+      return
+    with self._lock:
+      self._idle.append((conn, time.monotonic()))
+      self._lock.notify()
+
+  """
+    Logs every connection checked out for longer than the leak timeout
+  """
+  def check_leaks(self):
+    now = time.monotonic()
+    leaks = [(now - since, stack) for since, stack in
+             list(self._checked_out.values())
+             if now - since > self._leak_timeout]
+    for age, stack in leaks:
+      logging.warning('Connection checked out for ' + str(int(age)) +
+                      ' seconds, possible leak from:\n' +
+                      ''.join(traceback.format_list(stack)))
+    return len(leaks)
+
+  def get_stats(self):
+    with self._lock:
+      return {'size': self._size, 'idle': len(self._idle),
+              'checked_out': len(self._checked_out)}
+
+  def close(self):
+    with self._lock:
+      idle = self._idle
+      self._idle = []
+      self._size -= len(idle)
+    for conn, _ in idle:
+      conn.close()
+
+  def _warm(self):
+    if self._warmed:
+      return
+    with self._lock:
+      if self._warmed:
+        return
+      self._warmed = True
+      count = max(0, self._min_size - self._size)
+      self._size += count
+    opened = 0
+    try:
+      for _ in range(count):
+        conn = psycopg2.connect(self._connection_string)
+        opened += 1
+        self.putconn(conn)
+    except Exception as e:
+      logging.info('Error: could not open pooled connection ' + str(e))
+      with self._lock:
+        self._size -= count - opened
+        self._warmed = False
+
+  def _is_valid(self, conn, returned):
+    if conn.closed:
+      return False
+    if time.monotonic() - returned < self._validate_after:
+      return True
+    try:
+      with conn.cursor() as cur:
+        cur.execute('SELECT 1')
+      conn.rollback()
+      return True
+    except Exception:
+      return False
+
+  def _discard(self, conn):
+    try:
+      conn.close()
+    except Exception:
+      pass
+    with self._lock:
+      self._size -= 1
+      self._lock.notify()
+
+
 """
   Generic database accessor class for Postgres
 """
@@ -129,6 +351,11 @@ class PostgresAccessor:
               host=self._host, db=self._dbname
       )
     )
+    # every accessor on the same database shares one pool
+    self._pool = PostgresConnectionPool.get_pool(
+      self._connection_string,
+      min_size=config.get('pool_min_size', POOL_MIN_SIZE),
+      max_size=config.get('pool_max_size', POOL_MAX_SIZE))
 
   """
     Creates DJango Query class for insert statements
@@ -207,59 +434,54 @@ class PostgresAccessor:
     Executes a an insert, update or delete sql statement
   """
   def _execute_dml (self, query, args, raise_exception=False):
-    conn = None
-    cur = None
     try :
-      conn = psycopg2.connect(self._connection_string)
-      cur  = conn.cursor()
-      cur.execute(query, args)
-      conn.commit()
+      with self._pool.connection() as conn:
+        with conn.cursor() as cur:
+          cur.execute(query, args)
+        conn.commit()
     except Exception as e:
       if raise_exception :
         raise e
       else :
         logging.info('Error: Encountered exception ' + str(e))
-    finally :
-      if cur :
-        cur.close()
-      if conn :
-        conn.close()
 
   """
-    Executes a an insert, update or delete sql statement
+    Executes a select statement. result_format picks the shape of the result:
+      DICT_RESULT      list of dicts, one per row (default)
+      TUPLE_RESULT     list of named tuples sharing one column index
+      COLUMNAR_RESULT  dict of column name -> list of values
+      DATAFRAME_RESULT pandas DataFrame, pandas is only imported for this
+    Numeric values are converted to float by the cursor. Returns None when
+    there are no rows or the query failed.
   """
-  def _execute_query (self, query, args):
+  def _execute_query (self, query, args, result_format=DICT_RESULT):
     response = None
-    conn = None
-    cur = None
     try :
       logging.debug('Executing query: ' + query + '\n args: ' + str(args))
-      conn = psycopg2.connect(self._connection_string)
-      conn.autocommit = True
-      cur = conn.cursor()
-      cur.execute(query, args)
-      column_names = [desc[0] for desc in cur.description]
-      query_data = cur.fetchall()
+      if result_format == DICT_RESULT:
+        cursor_factory = psycopg2.extras.RealDictCursor
+      elif result_format == TUPLE_RESULT:
+        cursor_factory = psycopg2.extras.NamedTupleCursor
+      else:
+        cursor_factory = None
+      with self._pool.connection() as conn:
+        conn.autocommit = True
+        with conn.cursor(cursor_factory=cursor_factory) as cur:
+          psycopg2.extensions.register_type(DEC2FLOAT, cur)
+          cur.execute(query, args)
+          column_names = [desc[0] for desc in cur.description]
+          query_data = cur.fetchall()
       if query_data and len(query_data) > 0 :
-        response = []
-        for row in query_data :
-          row_dict = {}
-          counter = 0
-          for column in column_names :
-            value = row[counter]
-            #Decimal type will not convert to JSON
-            if isinstance(value, Decimal) :
-              value = float(value)
-            row_dict[column] = value
-            counter += 1
-          response.append(row_dict)
+        if result_format == COLUMNAR_RESULT:
+          response = dict(zip(column_names, map(list, zip(*query_data))))
+        elif result_format == DATAFRAME_RESULT:
+          import pandas
+          response = pandas.DataFrame.from_records(query_data,
+                                                   columns=column_names)
+        else:
+          response = query_data
     except Exception as e:
       logging.info('Error: Encountered exception ' + str(e))
-    finally :
-      if cur :
-        cur.close()
-      if conn :
-        conn.close()
 
     return response
 
@@ -272,15 +494,14 @@ class PostgresAccessor:
     loid = None
 
     try:
-      conn = psycopg2.connect(self._connection_string)
-      lobj = conn.lobject(0, 'w', 0)
-      data = str.encode(ldata)
-      len_value  = lobj.write(data)
+      with self._pool.connection() as conn:
+        lobj = conn.lobject(0, 'w', 0)
+        data = str.encode(ldata)
+        len_value  = lobj.write(data)
 
-      logging.debug('largeobject bytes written: ' + str(len_value))
+        logging.debug('largeobject bytes written: ' + str(len_value))
 
-      conn.commit()
-      conn.close()
+        conn.commit()
 
       loid = lobj.oid
     except Exception as e:
@@ -297,14 +518,13 @@ class PostgresAccessor:
     rval = True
 
     try:
-      conn = psycopg2.connect(self._connection_string)
-      lobj = conn.lobject(loid, 'r', 0)
+      with self._pool.connection() as conn:
+        lobj = conn.lobject(loid, 'r', 0)
 
-      lobj.unlink()
-      logging.debug('largeobject ' + str(loid) + ' removed')
+        lobj.unlink()
+        logging.debug('largeobject ' + str(loid) + ' removed')
 
-      conn.commit()
-      conn.close()
+        conn.commit()
     except Exception as e:
       logging.error('Encountered exception: ' + str(e) +
                     '\nRetrieving blob id: ' + str(loid))
@@ -321,17 +541,16 @@ class PostgresAccessor:
     data = None
 
     try:
-      conn = psycopg2.connect(self._connection_string)
-      lobj = conn.lobject(loid, 'r', 0)
+      with self._pool.connection() as conn:
+        lobj = conn.lobject(loid, 'r', 0)
 
-      lobj.seek(0)
+        lobj.seek(0)
 
-      data = lobj.read()
+        data = lobj.read()
 
-      logging.debug('largeobject bytes read: ' +  str(len(data)))
+        logging.debug('largeobject bytes read: ' +  str(len(data)))
 
-      conn.commit()
-      conn.close()
+        conn.commit()
     except Exception as e:
       logging.error('Error: Encountered exception retrieving object id ' +
                     str(e))
@@ -343,11 +562,11 @@ class PostgresAccessor:
     Retrieve a tuple list of all tables in current DB (tuple [0] = db name)
     :return: res is the result tuple list
     """
-    conn = psycopg2.connect(self._connection_string)
-    cursor = conn.cursor()
-    cursor.execute("select relname from pg_class where (relkind='r' or relkind='v') and relname !~ '^(pg_|sql_)' \
-                    and pg_catalog.pg_table_is_visible(oid)")
-    res = cursor.fetchall()
+    with self._pool.connection() as conn:
+      with conn.cursor() as cursor:
+        cursor.execute("select relname from pg_class where (relkind='r' or relkind='v') and relname !~ '^(pg_|sql_)' \
+                        and pg_catalog.pg_table_is_visible(oid)")
+        res = cursor.fetchall()
 
     return res
 
@@ -358,12 +577,12 @@ class PostgresAccessor:
     :return: fields is the list of all table fields
     """
     fields = []
-    conn   = psycopg2.connect(self._connection_string)
-    cursor = conn.cursor()
-    try:
-      cursor.execute('select * from ' + table + ' limit 1')
-      fields = [desc[0] for desc in cursor.description]
-    except Exception as e:
-      print(str(e))
+    with self._pool.connection() as conn:
+      with conn.cursor() as cursor:
+        try:
+          cursor.execute('select * from ' + table + ' limit 1')
+          fields = [desc[0] for desc in cursor.description]
+        except Exception as e:
+          print(str(e))
 
     return fields